@@ -0,0 +1,3 @@
+$ sum_(k=1)^n k^2 &= (n(n+1)(2n+1))/6 \
+  integral_0^1 x^2 dif x &= 1/3 \
+  lim_(x -> 0) (sin x)/x &= 1 $
@@ -0,0 +1,9 @@
+#box(width: 6cm, height: 5cm)[
+  #place(line(start: (0cm, 4cm), end: (5cm, 4cm)))
+  #place(line(start: (5cm, 4cm), end: (1.5cm, 0cm)))
+  #place(line(start: (1.5cm, 0cm), end: (0cm, 4cm)))
+  #place(dx: 1.5cm, dy: 0cm, line(length: 4cm, angle: 90deg, stroke: (dash: "dashed")))
+  #place(dx: -0.3cm, dy: 4cm)[$A$]
+  #place(dx: 5.1cm, dy: 4cm)[$B$]
+  #place(dx: 1.4cm, dy: -0.5cm)[$C$]
+]
@@ -0,0 +1,2 @@
+$ (x + 1/2 $
+#let f(x) = {
@@ -0,0 +1 @@
+$ fracc(1, 2) + xyz $
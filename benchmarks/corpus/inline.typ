@@ -0,0 +1,2 @@
+Let $n$ be a positive integer. Prove that $n^5 - n$ is divisible by $30$, and that
+$binom(2n, n) <= 4^n$ for all $n >= 1$.
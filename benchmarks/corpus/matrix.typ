@@ -0,0 +1 @@
+$ mat(1, 2, 3; 4, 5, 6; 7, 8, 9) vec(x, y, z) = vec(a, b, c) quad det mat(a, b; c, d) = a d - b c $
@@ -0,0 +1,18 @@
+*Problem 1.* Find all functions $f: RR -> RR$ such that
+$ f(x + f(y)) = f(x) + y $
+for all real $x$ and $y$.
+
+#pagebreak()
+
+*Problem 2.* Let $A B C$ be a triangle with circumcenter $O$ and orthocenter $H$. Show that
+$angle B A H = angle C A O$.
+
+#pagebreak()
+
+*Problem 3.* Prove that for all positive reals $a, b, c$,
+$ a/(b + c) + b/(c + a) + c/(a + b) >= 3/2. $
+
+#pagebreak()
+
+*Problem 4.* Let $p$ be an odd prime. Show that
+$ sum_(k=1)^(p-1) k^(p-2) equiv 0 quad (mod p). $
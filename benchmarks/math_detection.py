@@ -0,0 +1,86 @@
+"""Measures how well the passive math filter separates math from other messages with dollar signs.
+
+Compares looks_like_math with the plain regex the bot used before, on a labelled corpus of chat
+messages in math_messages.jsonl. Run from the repository root:
+
+    python -m benchmarks.math_detection --verbose
+"""
+
+import argparse
+import json
+import re
+import time
+from pathlib import Path
+from typing import Callable
+
+from bmt_discord_bot.lib.formats import TabularData
+from bmt_discord_bot.lib.mathdetect import looks_like_math
+
+CORPUS = Path(__file__).parent / "math_messages.jsonl"
+
+
+def legacy(text: str) -> bool:
+    return re.search(r"\$.+\$", text) is not None
+
+
+CLASSIFIERS: dict[str, Callable[[str], bool]] = {
+    "regex": legacy,
+    "looks_like_math": looks_like_math,
+}
+
+
+def load_corpus(path: Path) -> list[tuple[str, bool]]:
+    with open(path) as f:
+        return [(entry["text"], entry["math"]) for entry in map(json.loads, f) if entry]
+
+
+def timed(classify: Callable[[str], bool], texts: list[str], iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for text in texts:
+            classify(text)
+    return (time.perf_counter() - start) / (iterations * len(texts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", type=Path, default=CORPUS)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--verbose", action="store_true", help="list misclassified messages")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    texts = [text for text, _ in corpus]
+    table = TabularData()
+    table.set_columns(["Classifier", "Precision", "Recall", "False positives", "Per message (µs)"])
+    mistakes = {}
+    for name, classify in CLASSIFIERS.items():
+        predictions = [classify(text) for text in texts]
+        tp = sum(p and label for p, (_, label) in zip(predictions, corpus))
+        fp = sum(p and not label for p, (_, label) in zip(predictions, corpus))
+        fn = sum(not p and label for p, (_, label) in zip(predictions, corpus))
+        mistakes[name] = [
+            (text, label) for p, (text, label) in zip(predictions, corpus) if p != label
+        ]
+        table.add_row(
+            [
+                name,
+                f"{tp / (tp + fp):.1%}" if tp + fp else "n/a",
+                f"{tp / (tp + fn):.1%}" if tp + fn else "n/a",
+                fp,
+                f"{timed(classify, texts, args.iterations) * 1e6:.1f}",
+            ]
+        )
+
+    print(f"{len(corpus)} messages, {sum(label for _, label in corpus)} labelled as math")
+    print(table.render())
+
+    if args.verbose:
+        for name, wrong in mistakes.items():
+            print(f"\n{name} got {len(wrong)} wrong:")
+            for text, label in wrong:
+                print(f"  [{'math' if label else 'not math'}] {text!r}")
+
+
+if __name__ == "__main__":
+    main()
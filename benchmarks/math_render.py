@@ -0,0 +1,421 @@
+"""Renders the snippet corpus with each math renderer and reports how fast and how big it was.
+
+Every renderer runs in its own subprocess, without Discord or the render pool, so that its peak
+RSS can be attributed to it. Files in corpus/ ending in .tex go to TeX and .typ to Typst; files
+whose names start with "error-" are expected not to compile. The snippets are also rendered as
+a batch, which should give each of them a page cropped the same as when it is rendered alone,
+and blame a broken snippet in the middle of it for the error. TeX snippets are also compiled
+cold, the way the bot did before it had warm workers, to compare the compile times and check
+that the workers report the same errors. Run from the repository root:
+
+    python -m benchmarks.math_render --iterations 5 --output before.json
+    python -m benchmarks.math_render --iterations 5 --compare before.json
+
+TeX needs a full TeX Live, which the bot's Docker image has:
+
+    docker build -t bmt-discord-bot .
+    docker run --rm bmt-discord-bot python -m benchmarks.math_render --renderer tex
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pylatex
+import pymupdf
+
+from bmt_discord_bot.cogs.math import (
+    PNG_ENCODING,
+    CompileError,
+    LatexRenderer,
+    MathRenderer,
+    TypstRenderer,
+    content_rect,
+)
+from bmt_discord_bot.lib.formats import TabularData
+from bmt_discord_bot.lib.stats import RollingWindow, StageTimer
+
+CORPUS = Path(__file__).parent / "corpus"
+RENDERERS: dict[str, type[MathRenderer]] = {".tex": LatexRenderer, ".typ": TypstRenderer}
+# The stages timed inside a renderer; total and upload only exist in the bot.
+STAGES = ["compile", "open", "rasterize", "process", "encode"]
+# How far apart, in points, a page rendered in a batch and alone can be and still count as the same.
+BATCH_TOLERANCE = 1
+
+
+def corpus_files(corpus: Path, renderer: type[MathRenderer]) -> list[Path]:
+    return sorted(path for path in corpus.iterdir() if RENDERERS.get(path.suffix) is renderer)
+
+
+def cold_compile(renderer: LatexRenderer, source: str) -> bytes:
+    """Compiles like the bot did before warm workers: a new pdflatex, loading the full preamble
+    from source, run through texfot.
+    """
+
+    with TemporaryDirectory() as directory:
+        path = Path(directory) / "cold"
+        document = renderer.document(source)
+        try:
+            document.generate_pdf(
+                str(path), compiler="texfot", compiler_args=["--quiet", "pdflatex"]
+            )
+        except pylatex.errors.CompilerError as e:
+            raise CompileError(e)
+        except subprocess.CalledProcessError as e:
+            raise CompileError(e.output.decode(errors="replace"))
+        return path.with_suffix(".pdf").read_bytes()
+
+
+def first_error(log: str) -> str | None:
+    return next((line for line in log.splitlines() if line.startswith("!")), None)
+
+
+def page_sizes(renderer: MathRenderer, source: str, batch: bool = False) -> list[list[float]]:
+    doc = pymupdf.open(stream=renderer.compile_source(source, batch), filetype="pdf")
+    return [[rect.width, rect.height] for rect in map(content_rect, doc)]
+
+
+def compare_cold(renderer: LatexRenderer, source: str, iterations: int, error: str | None) -> dict:
+    times = RollingWindow(size=iterations)
+    cold_error = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        try:
+            cold_compile(renderer, source)
+        except CompileError as e:
+            cold_error = str(e)
+        times.add(time.perf_counter() - start)
+    return {
+        "cold_compile_p50": times.percentile(50),
+        "cold_error": first_error(cold_error) if cold_error is not None else None,
+        "warm_error": first_error(error) if error is not None else None,
+    }
+
+
+def check_batch(renderer: MathRenderer, files: list[Path]) -> dict:
+    snippets, alone = {}, {}
+    for path in files:
+        if path.name.startswith("error-"):
+            continue
+        try:
+            sizes = page_sizes(renderer, path.read_text())
+        except CompileError:
+            continue
+        # Snippets that already take several pages can't be matched up with one batch page.
+        if len(sizes) == 1:
+            snippets[path.name] = path.read_text()
+            alone[path.name] = sizes[0]
+
+    source = renderer.join_snippets(list(snippets.values()))
+    try:
+        pages = page_sizes(renderer, source, batch=True)
+    except CompileError as e:
+        return {"snippets": len(snippets), "error": str(e).splitlines()[0]}
+    miscropped = [
+        name
+        for name, batched in zip(snippets, pages)
+        if any(abs(a - b) > BATCH_TOLERANCE for a, b in zip(alone[name], batched))
+    ]
+
+    # Each broken snippet goes in the middle, so that blaming the first or last one is wrong.
+    blamed = {}
+    middle = len(snippets) // 2
+    sources = list(snippets.values())
+    for path in files:
+        if not path.name.startswith("error-"):
+            continue
+        broken = renderer.join_snippets([*sources[:middle], path.read_text(), *sources[middle:]])
+        try:
+            renderer.compile_source(broken, batch=True)
+            blamed[path.name] = "compiled"
+        except CompileError as e:
+            blamed[path.name] = renderer.failed_snippet(broken, str(e))
+
+    return {
+        "snippets": len(snippets),
+        "pages": len(pages),
+        "miscropped": miscropped,
+        "expected_blame": middle + 1,
+        "blamed": blamed,
+    }
+
+
+def peak_rss_kib(who: int) -> int:
+    return resource.getrusage(who).ru_maxrss
+
+
+def child(key: str, corpus: Path, iterations: int):
+    renderer_class = next(r for r in RENDERERS.values() if r.key == key)
+    renderer = renderer_class()
+    result = {"renderer": key, "available": True}
+    if isinstance(renderer, LatexRenderer):
+        try:
+            renderer.prepare()
+        except CompileError as e:
+            json.dump(result | {"available": False, "reason": str(e)}, sys.stdout)
+            return
+
+    files = corpus_files(corpus, renderer_class)
+    latency = RollingWindow(size=iterations * len(files))
+    stages = {stage: RollingWindow(size=iterations * len(files)) for stage in STAGES}
+    snippets = {}
+    for path in files:
+        source = path.read_text()
+        # One unmeasured render first, so worker startup and format loading aren't counted.
+        try:
+            renderer.render(source)
+        except CompileError:
+            pass
+
+        times = RollingWindow(size=iterations)
+        compiles = RollingWindow(size=iterations)
+        outcome = {"expected_error": path.name.startswith("error-"), "error": False}
+        error = None
+        for _ in range(iterations):
+            with StageTimer() as timer:
+                start = time.perf_counter()
+                try:
+                    output = renderer.render(source)
+                except CompileError as e:
+                    outcome["error"] = True
+                    error = str(e)
+                    output = None
+                elapsed = time.perf_counter() - start
+            times.add(elapsed)
+            latency.add(elapsed)
+            compiles.add(timer.stages.get("compile", elapsed))
+            for stage, seconds in timer.stages.items():
+                stages[stage].add(seconds)
+        p50, p95 = times.percentiles(50, 95)
+        outcome |= {"p50": p50, "p95": p95}
+        if isinstance(renderer, LatexRenderer):
+            outcome |= compare_cold(renderer, source, iterations, error)
+            outcome["compile_p50"] = compiles.percentile(50)
+        if output is not None:
+            outcome |= {"pages": len(output.pages), "bytes": sum(map(len, output.pages))}
+        snippets[path.name] = outcome
+
+    batch = check_batch(renderer, files)
+
+    if isinstance(renderer, LatexRenderer):
+        renderer.close()
+
+    p50, p95 = latency.percentiles(50, 95)
+    result |= {
+        "renders": latency.total,
+        "seconds": sum(latency.samples),
+        "throughput": latency.total / sum(latency.samples) if latency.total else None,
+        "p50": p50,
+        "p95": p95,
+        "peak_rss_kib": peak_rss_kib(resource.RUSAGE_SELF),
+        "peak_children_rss_kib": peak_rss_kib(resource.RUSAGE_CHILDREN),
+        "bytes": sum(snippet.get("bytes", 0) for snippet in snippets.values()),
+        "stages": {stage: window.percentile(50) for stage, window in stages.items() if window},
+        "snippets": snippets,
+        "batch": batch,
+    }
+    json.dump(result, sys.stdout)
+
+
+def run_child(key: str, corpus: Path, iterations: int) -> dict:
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.math_render",
+            "--corpus",
+            str(corpus),
+            "--iterations",
+            str(iterations),
+            "--child",
+            key,
+        ],
+        capture_output=True,
+        check=True,
+    )
+    return json.loads(process.stdout)
+
+
+def git_revision() -> str | None:
+    try:
+        process = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return process.stdout.strip()
+
+
+def ms(seconds: float | None) -> str:
+    return "n/a" if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def change(new: float | None, old: float | None) -> str:
+    if new is None or not old:
+        return "n/a"
+    return f"{(new - old) / old:+.1%}"
+
+
+def print_results(results: list[dict]):
+    summary = TabularData()
+    summary.set_columns(
+        [
+            "Renderer",
+            "Renders",
+            "Renders/s",
+            "p50 (ms)",
+            "p95 (ms)",
+            "Peak RSS (MiB)",
+            "Children RSS (MiB)",
+            "Output (KiB)",
+        ]
+    )
+    snippets = TabularData()
+    snippets.set_columns(["Renderer", "Snippet", "p50 (ms)", "p95 (ms)", "Pages", "KiB", "Result"])
+    stages = TabularData()
+    stages.set_columns(["Renderer", *(f"{stage} (ms)" for stage in STAGES)])
+    batches = TabularData()
+    batches.set_columns(["Renderer", "Snippets", "Pages", "Cropped like alone", "Error", "Blamed"])
+    cold = TabularData()
+    cold.set_columns(["Snippet", "Cold (ms)", "Warm (ms)", "Speedup", "Error"])
+    compared_cold = False
+
+    for result in results:
+        if not result["available"]:
+            print(f"{result['renderer']} is unavailable: {result['reason']}")
+            continue
+        summary.add_row(
+            [
+                result["renderer"],
+                result["renders"],
+                f"{result['throughput']:.1f}",
+                ms(result["p50"]),
+                ms(result["p95"]),
+                f"{result['peak_rss_kib'] / 1024:.0f}",
+                f"{result['peak_children_rss_kib'] / 1024:.0f}",
+                f"{result['bytes'] / 1024:.0f}",
+            ]
+        )
+        stages.add_row([result["renderer"], *(ms(result["stages"].get(stage)) for stage in STAGES)])
+        for name, snippet in result["snippets"].items():
+            if snippet["error"] != snippet["expected_error"]:
+                outcome = "UNEXPECTED ERROR" if snippet["error"] else "UNEXPECTED SUCCESS"
+            else:
+                outcome = "error" if snippet["error"] else "ok"
+            snippets.add_row(
+                [
+                    result["renderer"],
+                    name,
+                    ms(snippet["p50"]),
+                    ms(snippet["p95"]),
+                    snippet.get("pages", "-"),
+                    f"{snippet['bytes'] / 1024:.0f}" if "bytes" in snippet else "-",
+                    outcome,
+                ]
+            )
+            if "cold_compile_p50" in snippet:
+                compared_cold = True
+                if snippet["warm_error"] == snippet["cold_error"]:
+                    error = snippet["warm_error"] or "-"
+                else:
+                    error = f"{snippet['warm_error']}, NOT {snippet['cold_error']}"
+                cold.add_row(
+                    [
+                        name,
+                        ms(snippet["cold_compile_p50"]),
+                        ms(snippet["compile_p50"]),
+                        f"{snippet['cold_compile_p50'] / snippet['compile_p50']:.1f}x",
+                        error,
+                    ]
+                )
+        batch = result["batch"]
+        if "error" in batch:
+            batches.add_row([result["renderer"], batch["snippets"], "-", batch["error"], "-", "-"])
+            continue
+        pages = batch["pages"]
+        if pages != batch["snippets"]:
+            pages = f"{pages}, NOT {batch['snippets']}"
+        miscropped = ", ".join(batch["miscropped"])
+        cropped = f"NOT {miscropped}" if miscropped else "all"
+        for name, blamed in batch["blamed"].items():
+            if blamed != batch["expected_blame"]:
+                blamed = f"{blamed}, NOT {batch['expected_blame']}"
+            batches.add_row([result["renderer"], batch["snippets"], pages, cropped, name, blamed])
+
+    print(summary.render())
+    print(stages.render())
+    print(snippets.render())
+    print(batches.render())
+    if compared_cold:
+        print("TeX compiles, cold as before warm workers:")
+        print(cold.render())
+
+
+def print_comparison(results: list[dict], baseline: dict):
+    old_by_renderer = {r["renderer"]: r for r in baseline["renderers"] if r["available"]}
+    table = TabularData()
+    table.set_columns(["Renderer", "Renders/s", "p50", "p95", "Peak RSS", "Output"])
+    for result in results:
+        old = old_by_renderer.get(result["renderer"])
+        if not result["available"] or old is None:
+            continue
+        table.add_row(
+            [
+                result["renderer"],
+                change(result["throughput"], old["throughput"]),
+                change(result["p50"], old["p50"]),
+                change(result["p95"], old["p95"]),
+                change(result["peak_rss_kib"], old["peak_rss_kib"]),
+                change(result["bytes"], old["bytes"]),
+            ]
+        )
+    revision = baseline["meta"].get("revision") or "baseline"
+    print(f"Compared with {revision}:")
+    print(table.render())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", type=Path, default=CORPUS)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument(
+        "--renderer",
+        action="append",
+        choices=[r.key for r in RENDERERS.values()],
+        help="only run this renderer (can be repeated)",
+    )
+    parser.add_argument("--output", type=Path, help="save the results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="compare with results saved by --output")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child, args.corpus, args.iterations)
+
+    keys = args.renderer or [r.key for r in RENDERERS.values()]
+    results = [run_child(key, args.corpus, args.iterations) for key in keys]
+    print_results(results)
+
+    if args.compare:
+        print_comparison(results, json.loads(args.compare.read_text()))
+
+    if args.output:
+        meta = {
+            "revision": git_revision(),
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "iterations": args.iterations,
+            "png_encoding": PNG_ENCODING,
+        }
+        args.output.write_text(json.dumps({"meta": meta, "renderers": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
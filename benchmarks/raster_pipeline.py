@@ -0,0 +1,139 @@
+"""Compares the page raster pipeline against the PIL crop/pad pipeline it replaced.
+
+Each variant runs in a fresh subprocess so that peak RSS can be attributed to it; pymupdf and
+Pillow allocate outside of Python's allocator, so tracemalloc would not see most of it.
+
+Run from the repository root:
+
+    python -m benchmarks.raster_pipeline --iterations 10
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+import pymupdf
+from PIL import Image, ImageOps
+
+from bmt_discord_bot.cogs.math import (
+    MIN_IMAGE_WIDTH,
+    PNG_ENCODINGS,
+    RENDER_DPI,
+    TypstRenderer,
+    rasterize_page,
+)
+from bmt_discord_bot.lib.formats import TabularData
+
+DOCUMENTS = {
+    "formula": "$ sum_(k=1)^n k = (n(n+1))/2 $",
+    "paragraph": "#set page(width: 12cm)\n#lorem(120)",
+    "diagram": "#set page(width: 16cm, height: 16cm)\n#circle(radius: 7cm)",
+}
+
+
+def legacy_page(page: pymupdf.Page) -> bytes:
+    im = page.get_pixmap(dpi=RENDER_DPI).pil_image()
+    im = im.convert("RGBA")
+    im = ImageOps.crop(im, 1)
+    width, height = im.size
+    im = ImageOps.pad(
+        im,
+        (max(MIN_IMAGE_WIDTH, width), height),
+        color=(255, 255, 255, 0),
+        centering=(0, 0.5),
+    )
+    buffer = io.BytesIO()
+    im.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def current_page(page: pymupdf.Page) -> bytes:
+    return rasterize_page(page)
+
+
+PIPELINES = {"legacy": legacy_page, "current": current_page}
+
+
+def rss_kib() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def child(pipeline: str, document: str, iterations: int):
+    pdf = TypstRenderer().compile_source(DOCUMENTS[document])
+    page = pymupdf.open(stream=pdf, filetype="pdf")[0]
+    baseline = rss_kib()
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        output = PIPELINES[pipeline](page)
+        times.append(time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    size = Image.open(io.BytesIO(output)).size
+    json.dump(
+        {
+            "time": statistics.median(times),
+            "peak": peak - baseline,
+            "bytes": len(output),
+            "size": size,
+        },
+        sys.stdout,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument(
+        "--child", nargs=2, metavar=("PIPELINE", "DOCUMENT"), help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.child:
+        return child(*args.child, args.iterations)
+
+    table = TabularData()
+    table.set_columns(["Document", "Pipeline", "ms/page", "Peak RSS (MiB)", "PNG (KiB)", "Size"])
+    variants = [("legacy", "balanced")] + [("current", encoding) for encoding in PNG_ENCODINGS]
+    for document in DOCUMENTS:
+        for pipeline, encoding in variants:
+            process = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.raster_pipeline",
+                    "--iterations",
+                    str(args.iterations),
+                    "--child",
+                    pipeline,
+                    document,
+                ],
+                env=os.environ | {"MATH_PNG_ENCODING": encoding},
+                capture_output=True,
+                check=True,
+            )
+            result = json.loads(process.stdout)
+            table.add_row(
+                [
+                    document,
+                    f"{pipeline} ({encoding})",
+                    f"{result['time'] * 1000:.1f}",
+                    f"{result['peak'] / 1024:.1f}",
+                    f"{result['bytes'] / 1024:.0f}",
+                    "x".join(map(str, result["size"])),
+                ]
+            )
+    print(table.render())
+
+
+if __name__ == "__main__":
+    main()
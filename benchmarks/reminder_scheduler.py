@@ -0,0 +1,126 @@
+"""Checks that the reminder scheduler dispatches every reminder, against an in-memory table.
+
+Reminders are created while the scheduler is reading windows from the table, which is where it
+is easiest to lose one: the read is a snapshot from before they were created, and the horizon
+moves past them once it returns. Needs no database. Run from the repository root:
+
+    python -m benchmarks.reminder_scheduler --reminders 2000 --window-size 50
+"""
+
+import argparse
+import asyncio
+import datetime
+import random
+import time
+
+import discord
+
+from bmt_discord_bot.cogs.reminders import ReminderScheduler
+
+
+class Table:
+    """Stands in for the reminders table and the pool's connection to it. Each read sees the
+    table as it was when it started, and takes a while to come back, like a query would.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.rows: dict[int, datetime.datetime] = {}
+        self.resolved: set[int] = set()
+        self.reads = 0
+
+    async def fetch(self, query: str, expires_at: datetime.datetime, id: int, limit: int):
+        self.reads += 1
+        snapshot = sorted(
+            (expires_at, id) for id, expires_at in self.rows.items() if id not in self.resolved
+        )
+        snapshot = [key for key in snapshot if key > (expires_at, id)][:limit]
+        await asyncio.sleep(self.latency)
+        return [{"id": id, "expires_at": expires_at} for expires_at, id in snapshot]
+
+
+def interleaved_add() -> bool:
+    """The case that used to lose a reminder: one is created while the last window is read, and
+    the read says there is nothing left past it.
+    """
+
+    async def run() -> bool:
+        table = Table(latency=0.01)
+        scheduler = ReminderScheduler(table, dispatch=None, window_size=10)
+        refill = asyncio.create_task(scheduler.refill())
+        await asyncio.sleep(0)
+        expires_at = discord.utils.utcnow() + datetime.timedelta(minutes=1)
+        table.rows[1] = expires_at
+        scheduler.add(1, expires_at)
+        await refill
+        return scheduler.peek() == expires_at
+
+    return asyncio.run(run())
+
+
+async def simulate(count: int, window_size: int, latency: float, spread: float) -> dict:
+    table = Table(latency)
+    dispatched: list[int] = []
+    lateness: list[float] = []
+
+    async def dispatch(ids: list[int]):
+        now = discord.utils.utcnow()
+        for id in ids:
+            if id not in table.resolved:
+                table.resolved.add(id)
+                dispatched.append(id)
+                lateness.append((now - table.rows[id]).total_seconds())
+
+    # Half the reminders are in the table from the start, so the scheduler reads windows of them
+    # while the other half are created.
+    start = discord.utils.utcnow()
+    due = [start + datetime.timedelta(seconds=random.uniform(0, spread)) for _ in range(count)]
+    for id, expires_at in enumerate(due[: count // 2], start=1):
+        table.rows[id] = expires_at
+    scheduler = ReminderScheduler(table, dispatch, window_size=window_size)
+    runner = asyncio.create_task(scheduler.run())
+    for id, expires_at in enumerate(due[count // 2 :], start=count // 2 + 1):
+        table.rows[id] = expires_at
+        scheduler.add(id, expires_at)
+        if random.random() < 0.1:
+            await asyncio.sleep(latency * random.random())
+
+    deadline = time.perf_counter() + spread + 5
+    while len(table.resolved) < count and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    runner.cancel()
+
+    lateness.sort()
+    return {
+        "missed": count - len(table.resolved),
+        "duplicates": len(dispatched) - len(set(dispatched)),
+        "reads": table.reads,
+        "p50": lateness[len(lateness) // 2] if lateness else None,
+        "max": lateness[-1] if lateness else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reminders", type=int, default=2000)
+    parser.add_argument("--window-size", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds per window read")
+    parser.add_argument("--spread", type=float, default=3, help="seconds reminders come due over")
+    args = parser.parse_args()
+
+    ok = interleaved_add()
+    print(f"Reminder created during the last window read: {'kept' if ok else 'LOST'}")
+
+    result = asyncio.run(simulate(args.reminders, args.window_size, args.latency, args.spread))
+    print(
+        f"{args.reminders} reminders in windows of {args.window_size}: "
+        f"{result['missed']} missed, {result['duplicates']} dispatched twice, "
+        f"{result['reads']} window reads, lateness p50 {result['p50'] or 0:.3f} s, "
+        f"max {result['max'] or 0:.3f} s"
+    )
+    if not ok or result["missed"] or result["duplicates"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,155 @@
+import asyncio
+import hashlib
 import io
-from typing import Optional
+import itertools
+import logging
+import math
+import multiprocessing
+import multiprocessing.util
+import os
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from enum import IntEnum
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import AsyncIterator, Awaitable, Callable, Iterator, NamedTuple, Optional
+import asyncpg
 import typst
 import re
-from pathlib import Path
-import subprocess
+import threading
+import time
 
 import discord
-from discord.ext import commands
-from jishaku.functools import executor_function
+from discord.ext import commands, tasks
 from pylatex import Document, NoEscape, Package
-import pylatex
-from PIL import Image, ImageOps
+from PIL import Image
 import pymupdf
 from abc import ABC, abstractmethod
-from tempfile import TemporaryDirectory
 
 from bmt_discord_bot import Bot, Context
+from bmt_discord_bot.lib import formats, sandbox
+from bmt_discord_bot.lib.latex import LatexError, LatexFormat, LatexWorkerPool
+from bmt_discord_bot.lib.mathdetect import looks_like_math
+from bmt_discord_bot.lib.stats import RollingWindow, StageTimer, timed
 
 
 DEFAULT_DEFAULT_RENDERER = "tex"
 MAX_LINES_FOR_ERROR_SHOWN_BY_DEFAULT = 10
 RENDER_DPI = 600
+MIN_RENDER_DPI = 150
+RENDER_PIXEL_BUDGET = 40_000_000
+MAX_RENDER_PAGES = 10
+CONTENT_MARGIN = 8
 MIN_IMAGE_WIDTH = 1500
+RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RENDER_CACHE_PERSIST = True
+RENDER_CACHE_RETENTION_DAYS = 30
+LATEX_WORKER_MAX_JOBS = 100
+COMPILE_LIMITS = sandbox.Limits(wall_time=20, cpu_time=15, memory=2 * 1024**3)
+RENDER_PROCESSES = int(os.environ.get("MATH_RENDER_PROCESSES", os.cpu_count() or 1))
+RENDER_USER_CONCURRENCY = 1
+RENDER_GUILD_CONCURRENCY = max(1, RENDER_PROCESSES - 1)
+RENDER_QUEUE_SIZE = 64
+RENDER_QUEUE_PASSIVE_SIZE = 48
+RENDER_QUEUE_USER_SIZE = 5
+RENDER_QUEUE_SPECULATIVE_SIZE = 8
+# Stages timed during a render, in the order they happen. Total is the whole render as seen from
+# the bot, including time spent waiting for and talking to a worker.
+RENDER_STAGES = ["compile", "open", "rasterize", "process", "encode", "total", "upload"]
+# How long to wait after an edit to a rendered message before rendering it again, so that a burst
+# of quick edits only costs one compile.
+EDIT_RENDER_DELAY = 1.5
+RENDER_BUSY_MESSAGE = "The math renderer is busy right now, please try again in a moment."
+PNG_ENCODINGS = {
+    "fast": {"compress_level": 1},
+    "balanced": {"compress_level": 6},
+    "small": {"compress_level": 9, "optimize": True},
+}
+PNG_ENCODING = os.environ.get("MATH_PNG_ENCODING", "balanced")
 
 
 CODE_BLOCK_RE = re.compile(r"```(\w+)\n(.*?)```", re.DOTALL)
 
+# Sources are compiled against the smallest precompiled preamble that has what they use. physics
+# redefines some standard macros as well as adding its own, so those count as uses too.
+PREAMBLE_VARIANTS = {
+    "base": frozenset(),
+    "tikz": frozenset({"tikz"}),
+    "physics": frozenset({"physics"}),
+    "full": frozenset({"tikz", "physics"}),
+}
+TIKZ_RE = re.compile(r"\\(?:tikz|pgf|usetikzlibrary)|\\begin\s*\{tikz")
+PHYSICS_MACROS = """
+    quantity qty pqty bqty vqty Bqty absolutevalue abs norm evaluated eval order commutator comm
+    anticommutator acomm poissonbracket pb vectorbold vb vectorarrow va vectorunit vu dotproduct
+    vdot crossproduct cross cp gradient grad divergence div curl laplacian Re Im Res trace tr Tr
+    rank Rank erf principalvalue pv PV qq qcomma qc qif qthen qelse qotherwise qunless qgiven
+    qusing qassume qsince qlet qfor qall qeven qodd qinteger qand qor qas qin differential dd
+    derivative dv partialderivative pderivative pdv variation var functionalderivative fdv bra
+    ket braket innerproduct ip outerproduct dyad ketbra op expectationvalue expval ev
+    matrixelement matrixel mel matrixquantity mqty pmqty Pmqty bmqty vmqty smqty spmqty sPmqty
+    sbmqty svmqty matrixdeterminant mdet smdet identitymatrix imat xmatrix xmat zeromatrix zmat
+    paulimatrix pmat diagonalmatrix dmat antidiagonalmatrix admat
+""".split()
+# Functions like \sin only behave differently under physics when given a bracketed argument.
+PHYSICS_FUNCTIONS = """
+    exp log ln det sin cos tan csc sec cot sinh cosh tanh csch sech coth arcsin arccos arctan
+    arccsc arcsec arccot asin acos atan acsc asec acot
+""".split()
+PHYSICS_RE = re.compile(
+    rf"\\(?:{'|'.join(PHYSICS_MACROS)})(?![A-Za-z])"
+    rf"|\\(?:{'|'.join(PHYSICS_FUNCTIONS)})\s*[(\[]"
+)
+# Batches are compiled as one document with a page per snippet. In TeX each snippet goes in an
+# environment that standalone crops to its own page.
+BATCH_SEPARATOR_RE = re.compile(r"^\s*---\s*$", re.MULTILINE)
+BATCH_ENVIRONMENT = "bmtsnippet"
+BATCH_PREAMBLE = (
+    rf"\newenvironment{{{BATCH_ENVIRONMENT}}}{{}}{{}}\standaloneenv{{{BATCH_ENVIRONMENT}}}"
+)
+MAX_BATCH_SNIPPETS = 50
+# Where in the document a compile error is, as pdflatex and Typst each report it.
+LATEX_ERROR_LINE_RE = re.compile(r"^l\.(\d+) ", re.MULTILINE)
+TYPST_ERROR_LINE_RE = re.compile(r"<bytes>:(\d+):\d+")
+MAX_FILES_PER_MESSAGE = 10
+# What TeX says is undefined: the control sequence that the first line of context after the
+# error ends with, or the environment.
+UNDEFINED_RE = re.compile(
+    r"^! Undefined control sequence\.\n.*\\([A-Za-z]+) ?$"
+    r"|^! LaTeX Error: Environment (\S+) undefined\.",
+    re.MULTILINE,
+)
+# The control sequences and environments each feature's packages define anywhere in a document,
+# so that an undefined one can be told apart from a typo. TikZ's drawing commands only exist
+# inside a picture, so they're undefined without one whatever the preamble.
+FEATURE_DEFINITIONS = {
+    "tikz": re.compile(r"tikz\w*|pgf\w*|usetikzlibrary|tikzpicture|tikzcd|scope"),
+    "physics": re.compile("|".join(PHYSICS_MACROS)),
+}
+
+
+def preamble_variant(source: str) -> str:
+    features = set()
+    if TIKZ_RE.search(source):
+        features.add("tikz")
+    if PHYSICS_RE.search(source):
+        features.add("physics")
+    return next(name for name, needs in PREAMBLE_VARIANTS.items() if needs == features)
+
+
+def missing_feature(error: str) -> str | None:
+    """The feature whose packages define what a compile error says is undefined, if any."""
+
+    if (match := UNDEFINED_RE.search(error)) is None:
+        return None
+    name = match.group(1) or match.group(2)
+    return next((f for f, defines in FEATURE_DEFINITIONS.items() if defines.fullmatch(name)), None)
+
+
+def split_snippets(source: str) -> list[str]:
+    return [snippet.strip() for snippet in BATCH_SEPARATOR_RE.split(source) if snippet.strip()]
+
 
 def strip_code_block(source: str) -> str:
     source = source.strip()
@@ -36,51 +160,188 @@ def strip_code_block(source: str) -> str:
     return source
 
 
+def normalize_source(source: str) -> str:
+    return "\n".join(line.rstrip() for line in source.strip().splitlines())
+
+
 class CompileError(Exception):
     pass
 
 
+class RenderPlan(NamedTuple):
+    dpi: int
+    pages: int
+    notes: list[str]
+
+
+class CompiledDocument(NamedTuple):
+    pdf: bytes
+    plan: RenderPlan
+    # Content rectangles of the pages to render, as (x0, y0, x1, y1).
+    clips: list[tuple[float, float, float, float]]
+
+
+class RenderResult(NamedTuple):
+    pages: list[bytes]
+    notes: list[str]
+
+
+class MathReply(NamedTuple):
+    content: str
+    view: "MathView"
+
+
+def plan_render(sizes: list[tuple[float, float]], max_pages: int = MAX_RENDER_PAGES) -> RenderPlan:
+    """Picks a resolution and page count for pages of the given sizes (in points) that fit within
+    RENDER_PIXEL_BUDGET. Small renders stay at RENDER_DPI; larger ones are scaled down to
+    MIN_RENDER_DPI, after which trailing pages are dropped.
+    """
+
+    def pixels(dpi: float, count: int) -> float:
+        return sum(width * height for width, height in sizes[:count]) * (dpi / 72) ** 2
+
+    count = min(len(sizes), max_pages)
+    area = pixels(72, count)
+    dpi = int(72 * math.sqrt(RENDER_PIXEL_BUDGET / area)) if area else RENDER_DPI
+    dpi = max(MIN_RENDER_DPI, min(RENDER_DPI, dpi))
+    while count > 1 and pixels(dpi, count) > RENDER_PIXEL_BUDGET:
+        count -= 1
+
+    notes = []
+    if count < len(sizes):
+        notes.append(f"Only showing the first {formats.plural(count):page} of {len(sizes)}.")
+    if pixels(dpi, count) > RENDER_PIXEL_BUDGET:
+        dpi = max(1, int(72 * math.sqrt(RENDER_PIXEL_BUDGET / pixels(72, count))))
+        notes.append("This page is very large, so it was rendered at a reduced resolution.")
+    return RenderPlan(dpi=dpi, pages=count, notes=notes)
+
+
+def content_rect(page: pymupdf.Page) -> pymupdf.Rect:
+    """Returns the area of the page worth rasterizing: the drawn content plus a margin, unless
+    that covers most of the page anyway, as it does for standalone and auto-sized pages.
+    """
+
+    bbox = pymupdf.EMPTY_RECT()
+    for _, rect in page.get_bboxlog():
+        bbox |= rect
+    if bbox.is_empty:
+        return page.rect
+    bbox = (bbox + (-CONTENT_MARGIN, -CONTENT_MARGIN, CONTENT_MARGIN, CONTENT_MARGIN)) & page.rect
+    if bbox.get_area() > 0.8 * page.rect.get_area():
+        return page.rect
+    return bbox
+
+
+def encode_png(im: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    with timed("encode"):
+        im.save(buffer, "PNG", **PNG_ENCODINGS[PNG_ENCODING])
+    return buffer.getvalue()
+
+
+def pad_page(im: Image.Image) -> Image.Image:
+    """Left-aligns a page on a transparent canvas at least MIN_IMAGE_WIDTH wide."""
+
+    width, height = im.size
+    if width >= MIN_IMAGE_WIDTH:
+        return im
+    canvas = Image.new("RGBA", (MIN_IMAGE_WIDTH, height), (255, 255, 255, 0))
+    canvas.paste(im, (0, 0))
+    return canvas
+
+
+def rasterize_page(
+    page: pymupdf.Page, dpi: int = RENDER_DPI, clip: pymupdf.Rect | None = None
+) -> bytes:
+    # Trim the one-pixel edge with the clip rect instead of cropping a copy afterwards, and wrap
+    # the pixmap's samples without copying. The only other allocation is the padded canvas.
+    edge = 72 / dpi
+    clip = (clip or page.rect) & (page.rect + (edge, edge, -edge, -edge))
+    with timed("rasterize"):
+        pixmap = page.get_pixmap(dpi=dpi, clip=clip)
+    with timed("process"):
+        size = (pixmap.width, pixmap.height)
+        im = Image.frombuffer("RGB", size, pixmap.samples_mv, "raw", "RGB", pixmap.stride, 1)
+        im = pad_page(im)
+    return encode_png(im)
+
+
 class MathRenderer(ABC):
     name: str
     key: str
     aliases: list[str]
+    # Bump whenever the preamble or page setup changes, so cached renders are invalidated.
+    preamble_version: str
 
     @abstractmethod
-    def compile_source(self, output_path: Path, source: str):
-        pass
-
-    @executor_function
-    def render(self, source: str):
-        def process_page(im: Image.Image):
-            im = im.convert("RGBA")
-            im = ImageOps.crop(im, 1)
-            width, height = im.size
-            im = ImageOps.pad(
-                im,
-                (max(MIN_IMAGE_WIDTH, width), height),
-                color=(255, 255, 255, 0),
-                centering=(0, 0.5),
-            )
-            buffer = io.BytesIO()
-            im.save(buffer, "PNG")
-            buffer.seek(0)
-            return buffer
+    def compile_source(self, source: str, batch: bool = False) -> bytes:
+        """Compiles the source to a PDF. Batches come from join_snippets, and should put each
+        snippet on a page of its own.
+        """
+
+    def compile_document(
+        self, source: str, max_pages: int = MAX_RENDER_PAGES, batch: bool = False
+    ) -> CompiledDocument:
+        with timed("compile"):
+            pdf = self.compile_source(source, batch)
+        with timed("open"):
+            doc = pymupdf.open(stream=pdf, filetype="pdf")
+            clips = [content_rect(page) for page in doc]
+            plan = plan_render([(clip.width, clip.height) for clip in clips], max_pages)
+        return CompiledDocument(pdf, plan, [tuple(clip) for clip in clips[: plan.pages]])
+
+    def iter_pages(self, document: CompiledDocument, start: int = 0) -> Iterator[bytes]:
+        """Rasterizes the pages one at a time, so only one is ever held as pixels."""
+
+        with timed("open"):
+            doc = pymupdf.open(stream=document.pdf, filetype="pdf")
+        for i in range(start, document.plan.pages):
+            yield rasterize_page(doc[i], document.plan.dpi, pymupdf.Rect(document.clips[i]))
+
+    def render(
+        self, source: str, max_pages: int = MAX_RENDER_PAGES, batch: bool = False
+    ) -> RenderResult:
+        document = self.compile_document(source, max_pages, batch)
+        return RenderResult(pages=list(self.iter_pages(document)), notes=document.plan.notes)
 
-        with TemporaryDirectory() as dir:
-            pdf_output_path = Path(dir) / "output.pdf"
-            self.compile_source(pdf_output_path, source)
-            doc = pymupdf.open(pdf_output_path)
-            return [process_page(page.get_pixmap(dpi=RENDER_DPI).pil_image()) for page in doc]
+    def render_first(
+        self, source: str, max_pages: int = MAX_RENDER_PAGES, batch: bool = False
+    ) -> tuple[RenderResult, CompiledDocument | None]:
+        """Renders only the first page. If there are more, also returns the compiled document to
+        rasterize them from; otherwise the result is already complete.
+        """
+
+        document = self.compile_document(source, max_pages, batch)
+        first = next(self.iter_pages(document))
+        result = RenderResult(pages=[first], notes=document.plan.notes)
+        return result, document if document.plan.pages > 1 else None
+
+    @abstractmethod
+    def join_snippets(self, snippets: list[str]) -> str:
+        """Combines snippets into one source that renders each of them on its own page."""
+
+    @abstractmethod
+    def failed_snippet(self, source: str, error: str) -> int | None:
+        """Which snippet of a batch, counting from 1, a compile error of it comes from, if the
+        error says where it is.
+        """
 
 
 class LatexRenderer(MathRenderer):
     name = "TeX"
     key = "tex"
     aliases = ["latex"]
+    preamble_version = "3"
 
-    def compile_source(self, output_path: Path, source: str):
+    def __init__(self, formats: dict[str, LatexFormat] | None = None):
+        self.formats = formats
+        self.format_directory: TemporaryDirectory | None = None
+        self.pool: LatexWorkerPool | None = None
+        self.lock = threading.Lock()
+
+    def document(self, source: str = "", variant: str = "full") -> Document:
+        features = PREAMBLE_VARIANTS[variant]
         document = Document(
-            default_filepath=str(output_path).removesuffix(".pdf"),
             documentclass="standalone",
             document_options="border=8pt,crop,varwidth=256pt",
         )
@@ -89,34 +350,622 @@ class LatexRenderer(MathRenderer):
         document.preamble.append(Package("amssymb"))
         document.preamble.append(Package("amsthm"))
         document.preamble.append(Package("enumerate"))
-        document.preamble.append(Package("tikz"))
-        document.preamble.append(NoEscape(r"\usetikzlibrary{calc}"))
-        document.preamble.append(Package(NoEscape("tikz-cd")))
+        document.preamble.append(Package("xcolor"))
+        if "tikz" in features:
+            document.preamble.append(Package("tikz"))
+            document.preamble.append(NoEscape(r"\usetikzlibrary{calc}"))
+            document.preamble.append(Package(NoEscape("tikz-cd")))
         document.preamble.append(Package("arcs"))
-        document.preamble.append(Package("physics"))
+        if "physics" in features:
+            document.preamble.append(Package("physics"))
+        return document
+
+    def prepare(self) -> dict[str, LatexFormat]:
+        """Dumps each preamble variant to a format file, if not already done."""
+
+        with self.lock:
+            if self.formats is not None:
+                return self.formats
+            self.format_directory = TemporaryDirectory(prefix="bmt-fmt-")
+            formats = {}
+            try:
+                for variant in PREAMBLE_VARIANTS:
+                    preamble, _, _ = (
+                        self.document(variant=variant).dumps().partition(r"\begin{document}")
+                    )
+                    formats[variant] = LatexFormat.dump(
+                        f"mathpreamble-{variant}", preamble, Path(self.format_directory.name)
+                    )
+            except (LatexError, OSError) as e:
+                self.format_directory.cleanup()
+                self.format_directory = None
+                raise CompileError(f"Could not prepare the TeX preamble.\n{e}")
+            self.formats = formats
+            return self.formats
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+            if self.format_directory is not None:
+                self.format_directory.cleanup()
+                self.format_directory = None
+
+    def compile_source(self, source: str, batch: bool = False) -> bytes:
+        variant = preamble_variant(source)
         try:
-            document.generate_pdf(compiler="texfot", compiler_args=["--quiet", "pdflatex"])
-        except pylatex.errors.CompilerError as e:
+            return self.compile_variant(source, variant, batch)
+        except CompileError as e:
+            # The scan can miss a macro, e.g. one built with \csname, so something undefined that
+            # a larger preamble would define gets one more try with that. Anything else, like a
+            # typo, would fail the same way again.
+            feature = missing_feature(str(e))
+            if feature is None or feature in PREAMBLE_VARIANTS[variant]:
+                raise
+            features = PREAMBLE_VARIANTS[variant] | {feature}
+            larger = next(name for name, needs in PREAMBLE_VARIANTS.items() if needs == features)
+            return self.compile_variant(source, larger, batch)
+
+    def join_snippets(self, snippets: list[str]) -> str:
+        return "\n".join(
+            f"\\begin{{{BATCH_ENVIRONMENT}}}\n{snippet}\n\\end{{{BATCH_ENVIRONMENT}}}"
+            for snippet in snippets
+        )
+
+    def failed_snippet(self, source: str, error: str) -> int | None:
+        if (match := LATEX_ERROR_LINE_RE.search(error)) is None:
+            return None
+        lines = self.job(source, "base", batch=True).splitlines()[: int(match.group(1))]
+        begin = rf"\begin{{{BATCH_ENVIRONMENT}}}"
+        return sum(line.strip() == begin for line in lines) or None
+
+    def job(self, source: str, variant: str, batch: bool = False) -> str:
+        """The file a worker compiles, which is the document less the preamble in its format."""
+
+        _, begin, body = self.document(source, variant).dumps().partition(r"\begin{document}")
+        if batch:
+            # Declared here rather than in the formats, since it changes how standalone crops.
+            begin = BATCH_PREAMBLE + begin
+        return begin + body
+
+    def compile_variant(self, source: str, variant: str, batch: bool = False) -> bytes:
+        formats = self.prepare()
+        with self.lock:
+            # One warm pdflatex per render process, whichever variant it has loaded, rather than
+            # one per variant that mostly sits idle.
+            if self.pool is None:
+                self.pool = LatexWorkerPool(
+                    formats["base"], size=1, max_jobs=LATEX_WORKER_MAX_JOBS, limits=COMPILE_LIMITS
+                )
+            pool = self.pool
+        try:
+            return pool.compile(self.job(source, variant, batch), formats[variant])
+        except LatexError as e:
             raise CompileError(e)
-        except subprocess.CalledProcessError as e:
-            raise CompileError(e.output.decode())
 
 
 class TypstRenderer(MathRenderer):
     name = "Typst"
     key = "typst"
     aliases = []
+    preamble_version = "1"
 
-    def compile_source(self, output_path: Path, source: str):
-        source_bytes = f"""
+    def document(self, source: str) -> bytes:
+        return f"""
             #set page(width: auto, height: auto, margin: 8pt)
             {source}
         """.encode("utf-8")
+
+    def compile(self, source: str, **kwargs) -> bytes | list[bytes]:
+        # Typst compiles in-process, so fork a sandboxed child to enforce the limits.
         try:
-            typst.compile(source_bytes, output_path, format="pdf")
-        except RuntimeError as e:
+            return sandbox.call(
+                typst.compile, self.document(source), limits=COMPILE_LIMITS, **kwargs
+            )
+        except (RuntimeError, sandbox.LimitExceeded) as e:
             raise CompileError(e)
 
+    def compile_source(self, source: str, batch: bool = False) -> bytes:
+        # Snippets are already split into pages by join_snippets.
+        return self.compile(source, format="pdf")
+
+    def join_snippets(self, snippets: list[str]) -> str:
+        return "\n#pagebreak()\n".join(snippets)
+
+    def failed_snippet(self, source: str, error: str) -> int | None:
+        if (match := TYPST_ERROR_LINE_RE.search(error)) is None:
+            return None
+        lines = self.document(source).decode("utf-8").splitlines()[: int(match.group(1))]
+        return 1 + sum(line.strip() == "#pagebreak()" for line in lines)
+
+
+# Renderers living in a render worker process, keyed by MathRenderer.key.
+_worker_renderers: dict[str, MathRenderer] = {}
+
+
+def _init_render_worker(latex_formats: dict[str, LatexFormat] | None):
+    tex = LatexRenderer(latex_formats)
+    multiprocessing.util.Finalize(tex, tex.close, exitpriority=10)
+    for renderer in (tex, TypstRenderer()):
+        _worker_renderers[renderer.key] = renderer
+
+
+def _render_job(
+    key: str, source: str, max_pages: int, batch: bool
+) -> tuple[RenderResult, dict[str, float]]:
+    with StageTimer() as timer:
+        result = _worker_renderers[key].render(source, max_pages, batch)
+    return result, timer.stages
+
+
+def _render_first_job(
+    key: str, source: str, max_pages: int, batch: bool
+) -> tuple[RenderResult, CompiledDocument | None, dict[str, float]]:
+    with StageTimer() as timer:
+        result, document = _worker_renderers[key].render_first(source, max_pages, batch)
+    return result, document, timer.stages
+
+
+def _rasterize_job(
+    key: str, document: CompiledDocument, index: int
+) -> tuple[bytes, dict[str, float]]:
+    with StageTimer() as timer:
+        page = next(_worker_renderers[key].iter_pages(document, index))
+    return page, timer.stages
+
+
+class RenderStats:
+    """Rolling timings of each render stage, per renderer. Every recording is also logged as one
+    line of key=value pairs, in milliseconds.
+    """
+
+    def __init__(self):
+        self.windows: defaultdict[tuple[str, str], RollingWindow] = defaultdict(RollingWindow)
+        self.logger = logging.getLogger(f"{__name__}.stats")
+
+    def record(self, renderer: MathRenderer, timings: dict[str, float]):
+        for stage, seconds in timings.items():
+            self.windows[renderer.key, stage].add(seconds)
+        fields = " ".join(f"{stage}_ms={seconds * 1000:.1f}" for stage, seconds in timings.items())
+        self.logger.info(f"renderer={renderer.key} {fields}")
+
+
+class PageStream:
+    """Hands pages of a render to a consumer as soon as each one is ready."""
+
+    def __init__(self):
+        self.queue: asyncio.Queue[bytes | None] = asyncio.Queue()
+        self.notes: list[str] = []
+        self.count = 0
+
+    def put(self, page: bytes):
+        self.queue.put_nowait(page)
+        self.count += 1
+
+    def finish(self, result: RenderResult):
+        """Passes on whatever the stream hasn't seen yet, e.g. when the result came from the cache."""
+
+        self.notes = result.notes
+        for page in result.pages[self.count :]:
+            self.put(page)
+        self.close()
+
+    def close(self):
+        self.queue.put_nowait(None)
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        while (page := await self.queue.get()) is not None:
+            yield page
+
+    async def batches(self) -> AsyncIterator[list[bytes]]:
+        """Like iterating over the stream, but hands over every page that has already arrived at
+        once, e.g. all of them when the result came from the cache.
+        """
+
+        finished = False
+        while not finished and (page := await self.queue.get()) is not None:
+            pages = [page]
+            while not self.queue.empty():
+                if (page := self.queue.get_nowait()) is None:
+                    finished = True
+                    break
+                pages.append(page)
+            yield pages
+
+
+class RenderEngine:
+    """Runs renders in a fixed pool of worker processes, so that compiling, rasterizing and PNG
+    encoding never hold the bot's GIL. Each worker keeps its own warm TeX worker.
+    """
+
+    def __init__(
+        self,
+        *,
+        processes: int = RENDER_PROCESSES,
+        latex_formats: dict[str, LatexFormat] | None,
+        stats: RenderStats | None = None,
+    ):
+        self.processes = processes
+        self.latex_formats = latex_formats
+        self.stats = stats or RenderStats()
+        self.executor = self._create_executor()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_render_worker,
+            initargs=(self.latex_formats,),
+        )
+
+    async def render(
+        self,
+        renderer: MathRenderer,
+        source: str,
+        stream: PageStream | None = None,
+        max_pages: int = MAX_RENDER_PAGES,
+        batch: bool = False,
+    ) -> RenderResult:
+        timer = StageTimer()
+        start = time.perf_counter()
+        # Every render that was using a broken pool sees it break, but only the first one to
+        # notice should replace it, or it would tear down the new pool and everything on it.
+        executor = self.executor
+        try:
+            result = await self._render(executor, renderer, source, stream, max_pages, batch, timer)
+        except BrokenProcessPool:
+            if self.executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self._create_executor()
+            raise CompileError("The renderer crashed. Please try again.")
+        timer.add("total", time.perf_counter() - start)
+        self.stats.record(renderer, timer.stages)
+        return result
+
+    async def _render(
+        self,
+        executor: ProcessPoolExecutor,
+        renderer: MathRenderer,
+        source: str,
+        stream: PageStream | None,
+        max_pages: int,
+        batch: bool,
+        timer: StageTimer,
+    ) -> RenderResult:
+        loop = asyncio.get_running_loop()
+        if stream is None:
+            result, stages = await loop.run_in_executor(
+                executor, _render_job, renderer.key, source, max_pages, batch
+            )
+            for stage, seconds in stages.items():
+                timer.add(stage, seconds)
+            return result
+
+        # Rasterize a page per job, so the first page can be shown while the rest are going.
+        result, document, stages = await loop.run_in_executor(
+            executor, _render_first_job, renderer.key, source, max_pages, batch
+        )
+        for stage, seconds in stages.items():
+            timer.add(stage, seconds)
+        stream.notes = result.notes
+        for page in result.pages:
+            stream.put(page)
+        if document is None:
+            return result
+        for i in range(1, document.plan.pages):
+            page, stages = await loop.run_in_executor(
+                executor, _rasterize_job, renderer.key, document, i
+            )
+            for stage, seconds in stages.items():
+                timer.add(stage, seconds)
+            stream.put(page)
+            result.pages.append(page)
+        return result
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class Priority(IntEnum):
+    COMMAND = 0
+    PASSIVE = 1
+    SPECULATIVE = 2
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+class RenderJob:
+    def __init__(self, key: str, priority: Priority, seq: int, user_id: int, guild_id: int | None):
+        self.key = key
+        self.priority = priority
+        self.seq = seq
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.queued_at = time.monotonic()
+        self.started: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+    @property
+    def order(self) -> tuple[int, int]:
+        return self.priority, self.seq
+
+
+class RenderScheduler:
+    """Decides which queued render runs next.
+
+    Jobs run in priority order, then arrival order, skipping any job whose user or guild already
+    has as many renders running as it is allowed. The queue is bounded, and passive jobs are turned
+    away before it is completely full so that commands can still get in. Speculative jobs have a
+    small allowance of their own and never take a place that a real request could use.
+    """
+
+    def __init__(
+        self,
+        *,
+        concurrency: int = RENDER_PROCESSES,
+        user_concurrency: int = RENDER_USER_CONCURRENCY,
+        guild_concurrency: int = RENDER_GUILD_CONCURRENCY,
+        max_queued: int = RENDER_QUEUE_SIZE,
+        max_passive_queued: int = RENDER_QUEUE_PASSIVE_SIZE,
+        max_user_queued: int = RENDER_QUEUE_USER_SIZE,
+        max_speculative_queued: int = RENDER_QUEUE_SPECULATIVE_SIZE,
+    ):
+        self.concurrency = concurrency
+        self.user_concurrency = user_concurrency
+        self.guild_concurrency = guild_concurrency
+        self.max_queued = max_queued
+        self.max_passive_queued = max_passive_queued
+        self.max_user_queued = max_user_queued
+        self.max_speculative_queued = max_speculative_queued
+        self.queued: list[RenderJob] = []
+        self.running = 0
+        self.running_by_user: Counter[int] = Counter()
+        self.running_by_guild: Counter[int] = Counter()
+        self.seq = itertools.count()
+        self.waits = RollingWindow()
+        self.shed = 0
+        self.logger = logging.getLogger(__name__)
+
+    async def run(
+        self,
+        render: Callable[[], Awaitable[RenderResult]],
+        *,
+        key: str,
+        priority: Priority,
+        user_id: int,
+        guild_id: int | None,
+    ) -> RenderResult:
+        self.admit(priority, user_id)
+        job = RenderJob(key, priority, next(self.seq), user_id, guild_id)
+        self.queued.append(job)
+        self.dispatch()
+
+        try:
+            await job.started
+        except asyncio.CancelledError:
+            if job in self.queued:
+                self.queued.remove(job)
+            else:
+                self.release(job)
+            raise
+
+        self.waits.add(time.monotonic() - job.queued_at)
+        # A worker can't be interrupted mid-render, so its slot stays taken until the render
+        # finishes even if nobody is waiting for the result anymore.
+        task = asyncio.ensure_future(render())
+        task.add_done_callback(lambda _: self.finish(job, task))
+        return await asyncio.shield(task)
+
+    def admit(self, priority: Priority, user_id: int):
+        queued = [job for job in self.queued if job.priority != Priority.SPECULATIVE]
+        if priority == Priority.SPECULATIVE:
+            limit = self.max_speculative_queued
+            queued = [job for job in self.queued if job.priority == Priority.SPECULATIVE]
+        elif priority == Priority.PASSIVE:
+            limit = self.max_passive_queued
+        else:
+            limit = self.max_queued
+
+        if len(queued) >= limit:
+            reason = "queue full"
+        elif sum(job.user_id == user_id for job in queued) >= self.max_user_queued:
+            reason = "user quota"
+        else:
+            return
+        self.shed += 1
+        log = self.logger.debug if priority == Priority.SPECULATIVE else self.logger.warning
+        log(
+            "Shedding %s render for user %s (%s, %d queued, %d running)",
+            priority.name.lower(),
+            user_id,
+            reason,
+            len(self.queued),
+            self.running,
+        )
+        raise RenderQueueFull()
+
+    def promote(self, key: str, priority: Priority):
+        """Moves queued jobs for key up to priority, for when a more urgent request joins them."""
+
+        for job in self.queued:
+            if job.key == key and priority < job.priority:
+                job.priority = priority
+        self.dispatch()
+
+    def eligible(self, job: RenderJob) -> bool:
+        if self.running_by_user[job.user_id] >= self.user_concurrency:
+            return False
+        if (
+            job.guild_id is not None
+            and self.running_by_guild[job.guild_id] >= self.guild_concurrency
+        ):
+            return False
+        return True
+
+    def dispatch(self):
+        while self.running < self.concurrency:
+            job = min(filter(self.eligible, self.queued), key=lambda j: j.order, default=None)
+            if job is None:
+                return
+            self.queued.remove(job)
+            self.running += 1
+            self.running_by_user[job.user_id] += 1
+            if job.guild_id is not None:
+                self.running_by_guild[job.guild_id] += 1
+            job.started.set_result(None)
+
+    def finish(self, job: RenderJob, task: asyncio.Future[RenderResult]):
+        self.release(job)
+        if not task.cancelled():
+            task.exception()
+
+    def release(self, job: RenderJob):
+        self.running -= 1
+        self.running_by_user[job.user_id] -= 1
+        if self.running_by_user[job.user_id] <= 0:
+            del self.running_by_user[job.user_id]
+        if job.guild_id is not None:
+            self.running_by_guild[job.guild_id] -= 1
+            if self.running_by_guild[job.guild_id] <= 0:
+                del self.running_by_guild[job.guild_id]
+        self.dispatch()
+
+
+class RenderCache:
+    """Content-addressed cache of render results.
+
+    Lookups go to a bounded in-memory LRU first, then to the math_render_cache table if a pool is
+    given. Concurrent misses for the same key share a single render, which is cancelled if every
+    caller waiting for it is. Compile errors are not cached. The table is only ever a shortcut,
+    so if it can't be reached the render goes ahead without it.
+    """
+
+    def __init__(
+        self, pool: asyncpg.Pool | None = None, *, max_bytes: int = RENDER_CACHE_MAX_BYTES
+    ):
+        self.pool = pool
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[str, RenderResult] = OrderedDict()
+        self.inflight: dict[str, asyncio.Task[RenderResult]] = {}
+        self.waiters: Counter[str] = Counter()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def key(
+        renderer: MathRenderer,
+        source: str,
+        max_pages: int = MAX_RENDER_PAGES,
+        batch: bool = False,
+    ) -> str:
+        settings = f"{RENDER_DPI}/{MIN_RENDER_DPI}/{RENDER_PIXEL_BUDGET}/{max_pages}"
+        if batch:
+            settings += "/batch"
+        parts = [renderer.key, renderer.preamble_version, settings, normalize_source(source)]
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> RenderResult | None:
+        result = self.entries.get(key)
+        if result is not None:
+            self.entries.move_to_end(key)
+        return result
+
+    def put(self, key: str, result: RenderResult):
+        if key in self.entries:
+            return
+        self.entries[key] = result
+        self.size += sum(len(page) for page in result.pages)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= sum(len(page) for page in evicted.pages)
+
+    async def get_or_render(
+        self, key: str, render: Callable[[], Awaitable[RenderResult]]
+    ) -> RenderResult:
+        if (result := self.get(key)) is not None:
+            self.hits += 1
+            return result
+
+        if (task := self.inflight.get(key)) is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.create_task(self._load_or_render(key, render))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+
+        self.waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self.waiters[key] == 1:
+                task.cancel()
+            raise
+        finally:
+            self.waiters[key] -= 1
+            if self.waiters[key] <= 0:
+                del self.waiters[key]
+
+    async def _load_or_render(
+        self, key: str, render: Callable[[], Awaitable[RenderResult]]
+    ) -> RenderResult:
+        if self.pool is not None:
+            try:
+                row = await self.pool.fetchrow(
+                    """
+                        UPDATE math_render_cache
+                        SET accessed_at = NOW()
+                        WHERE key = $1
+                        RETURNING pages, notes
+                    """,
+                    key,
+                )
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError):
+                self.logger.exception("Could not look up a render in the database, rendering it")
+                row = None
+            if row is not None:
+                self.persistent_hits += 1
+                result = RenderResult(pages=row["pages"], notes=row["notes"])
+                self.put(key, result)
+                return result
+
+        self.misses += 1
+        result = await render()
+        self.put(key, result)
+
+        if self.pool is not None:
+            # The result is already in memory, so it's served from there if this fails.
+            try:
+                await self.pool.execute(
+                    """
+                        INSERT INTO math_render_cache (key, pages, notes)
+                        VALUES ($1, $2, $3)
+                        ON CONFLICT (key) DO NOTHING
+                    """,
+                    key,
+                    result.pages,
+                    result.notes,
+                )
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError):
+                self.logger.exception("Could not save a render to the database")
+        return result
+
+    async def prune(self):
+        if self.pool is None:
+            return
+        await self.pool.execute(
+            """
+                DELETE FROM math_render_cache
+                WHERE accessed_at < NOW() - make_interval(days => $1)
+            """,
+            RENDER_CACHE_RETENTION_DAYS,
+        )
+
 
 class MathView(discord.ui.View):
     class RendererSelect(discord.ui.Select["MathView"]):
@@ -139,34 +988,75 @@ class MathView(discord.ui.View):
                 return
             value = int(self.values[0])
             renderer = self.renderers[value]
+            try:
+                await self.view.render(renderer, Priority.COMMAND)
+            except RenderQueueFull:
+                await interaction.response.send_message(RENDER_BUSY_MESSAGE, ephemeral=True)
+                return
             self.update_selected(renderer)
-            await self.view.render(renderer)
             await self.view.edit(interaction.message)
             await interaction.response.defer()
 
     def __init__(
         self,
+        math: "Math",
         ctx: Context,
         source: str,
         default_renderer: MathRenderer,
         renderers: list[MathRenderer],
+        priority: Priority = Priority.COMMAND,
     ):
         super().__init__()
+        self.math = math
         self.ctx = ctx
         self.source = source
+        self.priority = priority
         self.default_renderer = default_renderer
         self.renderers = renderers
         self.select_renderer = self.RendererSelect(default_renderer, renderers)
+        self.message: discord.Message | None = None
+        # Rendered images are only held until they're uploaded. After that the view keeps the
+        # message's attachments, which edits can pass back to Discord without uploading again.
+        self.files: list[discord.File] | None = None
+        self.attachments: list[discord.Attachment] = []
+        self.speculations: list[asyncio.Task] = []
+        self.prepared: dict[MathRenderer, RenderResult | CompileError] = {}
 
-    async def render(self, renderer: MathRenderer):
+    async def render(
+        self,
+        renderer: MathRenderer,
+        priority: Priority | None = None,
+        stream: PageStream | None = None,
+    ):
+        result = self.prepared.pop(renderer, None)
+        if result is None:
+            try:
+                result = await self.math.render(
+                    self.ctx,
+                    renderer,
+                    self.source,
+                    self.priority if priority is None else priority,
+                    stream,
+                )
+            except CompileError as e:
+                result = e
+        elif stream is not None and isinstance(result, RenderResult):
+            stream.finish(result)
+        elif stream is not None:
+            stream.close()
+        self.show(result)
+
+    def show(self, result: RenderResult | CompileError):
         self.remove_item(self.toggle_error)
         self.remove_item(self.select_renderer)
-        try:
-            bufs = await renderer.render(self.source)
-            self.files = [discord.File(buf, filename=f"math_{i}.png") for i, buf in enumerate(bufs)]
-            self.content = None
-        except CompileError as e:
-            error = str(e)
+        if isinstance(result, RenderResult):
+            self.files = [
+                discord.File(io.BytesIO(page), filename=f"math_{i}.png")
+                for i, page in enumerate(result.pages)
+            ]
+            self.content = "\n".join(result.notes) or None
+        else:
+            error = str(result)
             self.files = []
             self.content = f"**{self.ctx.author}**\nCompile error. Click \N{WARNING SIGN}\N{VARIATION SELECTOR-16} for more information."
             self.next_content = f"**{self.ctx.author}**\n```{error}```"
@@ -184,8 +1074,70 @@ class MathView(discord.ui.View):
             self.toggle_error.label,
         )
 
+    async def prefetch(self, current: MathRenderer):
+        """Speculates if the author has opted in. The dropdown is only offered after a compile
+        error, so that's the only time it's worth getting the other renderers ready, or looking up
+        whether to.
+        """
+
+        if self.select_renderer in self.children and await self.math.get_prefetch(self.ctx.author):
+            self.speculate(current)
+
+    def speculate(self, current: MathRenderer):
+        """Starts rendering the other renderers in the background, so that switching to one of them
+        in the dropdown doesn't have to wait for a compile.
+        """
+
+        assert self.message is not None
+        for renderer in self.renderers:
+            if renderer is not current:
+                self.speculations.append(asyncio.create_task(self._speculate(renderer)))
+        self.math.speculating[self.message.id] = self
+
+    async def _speculate(self, renderer: MathRenderer):
+        try:
+            result = await self.math.render(self.ctx, renderer, self.source, Priority.SPECULATIVE)
+        except CompileError as e:
+            result = e
+        except RenderQueueFull:
+            return
+        self.prepared[renderer] = result
+
+    def cancel_speculation(self):
+        for task in self.speculations:
+            task.cancel()
+        self.speculations.clear()
+        self.prepared.clear()
+        if self.message is not None:
+            self.math.speculating.pop(self.message.id, None)
+
+    async def rerender(self, renderer: MathRenderer, source: str, priority: Priority):
+        """Renders new source into the existing message, e.g. after the message it came from was
+        edited.
+        """
+
+        assert self.message is not None
+        self.cancel_speculation()
+        self.source = source
+        self.priority = priority
+        self.default_renderer = renderer
+        self.select_renderer.update_selected(renderer)
+        await self.render(renderer)
+        await self.edit(self.message)
+        await self.prefetch(renderer)
+
+    def stop(self):
+        super().stop()
+        self.math.replies.pop(self.ctx.message.id, None)
+
+    async def on_timeout(self):
+        self.cancel_speculation()
+        self.math.replies.pop(self.ctx.message.id, None)
+
     @discord.ui.button(emoji="\N{WASTEBASKET}")
     async def delete(self, interaction, button):
+        self.cancel_speculation()
+        self.stop()
         await interaction.message.delete()
         await interaction.response.defer()
 
@@ -196,12 +1148,49 @@ class MathView(discord.ui.View):
         await interaction.response.defer()
 
     async def send(self, channel: discord.abc.Messageable):
-        if not hasattr(self, "files"):
-            await self.render(self.default_renderer)
-        await channel.send(self.content, files=self.files, view=self)
+        # Post the first page as soon as it's rendered and add the others to the message as they
+        # come in, rather than waiting for the whole document. Pages that are already there by the
+        # time of an upload go up together, so a cached render is still a single message.
+        stream = PageStream()
+        rendering = asyncio.create_task(self.render(self.default_renderer, stream=stream))
+        timer = StageTimer()
+        try:
+            async for pages in stream.batches():
+                files = [
+                    discord.File(io.BytesIO(page), filename=f"math_{i}.png")
+                    for i, page in enumerate(pages, start=len(self.attachments))
+                ]
+                with timer, timed("upload"):
+                    if self.message is None:
+                        self.show(RenderResult(pages=[], notes=stream.notes))
+                        self.message = await channel.send(self.content, files=files, view=self)
+                    else:
+                        self.message = await self.message.edit(
+                            attachments=[*self.attachments, *files]
+                        )
+                self.uploaded(self.message)
+            await rendering
+        finally:
+            rendering.cancel()
+
+        if self.message is None:
+            self.message = await channel.send(self.content, files=self.files or [], view=self)
+            self.uploaded(self.message)
+        elif self.files is not None and len(self.files) != len(self.attachments):
+            # Rendering failed partway through, so show the error instead.
+            await self.edit(self.message)
+        self.files = None
+        if timer.stages:
+            self.math.stats.record(self.default_renderer, timer.stages)
+        await self.prefetch(self.default_renderer)
 
     async def edit(self, message: discord.Message):
-        await message.edit(content=self.content, attachments=self.files, view=self)
+        attachments = self.attachments if self.files is None else self.files
+        self.uploaded(await message.edit(content=self.content, attachments=attachments, view=self))
+
+    def uploaded(self, message: discord.Message):
+        self.files = None
+        self.attachments = message.attachments
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         if interaction.user == self.ctx.author or self.ctx.bot.is_owner(interaction.user):
@@ -220,6 +1209,76 @@ class Math(commands.Cog):
         self.renderers = [tex, typst]
         self.renderer_by_key = {r.key: r for r in self.renderers}
         self.renderer_by_key |= {alias: r for r in self.renderers for alias in r.aliases}
+        self.tex = tex
+        self.cache = RenderCache(bot.database.pool if RENDER_CACHE_PERSIST else None)
+        self.speculating: dict[int, MathView] = {}
+        # Rendered replies to messages the bot noticed math in, by the ID of the message, so that
+        # edits to it can be rendered into the same reply.
+        self.replies: dict[int, MathReply] = {}
+        self.pending_edits: dict[int, asyncio.Task] = {}
+        # Users' prefetch settings, by user ID, as they were last read or set.
+        self.prefetch_settings: dict[int, bool] = {}
+        self.stats = RenderStats()
+        self.logger = logging.getLogger(__name__)
+
+    async def cog_load(self):
+        self.prune_cache.start()
+        try:
+            latex_formats = await asyncio.to_thread(self.tex.prepare)
+        except CompileError:
+            self.logger.exception("Could not prepare the TeX formats, workers will retry")
+            latex_formats = None
+        self.engine = RenderEngine(latex_formats=latex_formats, stats=self.stats)
+        self.scheduler = RenderScheduler(concurrency=self.engine.processes)
+
+    async def cog_unload(self):
+        self.prune_cache.cancel()
+        for view in list(self.speculating.values()):
+            view.cancel_speculation()
+        for task in self.pending_edits.values():
+            task.cancel()
+        await asyncio.to_thread(self.engine.shutdown)
+        self.tex.close()
+
+    @tasks.loop(hours=24)
+    async def prune_cache(self):
+        """Drops persisted renders that haven't been looked at in a while."""
+
+        try:
+            await self.cache.prune()
+        except Exception:
+            self.logger.exception("Could not prune the math render cache")
+
+    async def render(
+        self,
+        ctx: Context,
+        renderer: MathRenderer,
+        source: str,
+        priority: Priority,
+        stream: PageStream | None = None,
+        max_pages: int = MAX_RENDER_PAGES,
+        batch: bool = False,
+    ) -> RenderResult:
+        key = self.cache.key(renderer, source, max_pages, batch)
+        self.scheduler.promote(key, priority)
+        try:
+            result = await self.cache.get_or_render(
+                key,
+                lambda: self.scheduler.run(
+                    lambda: self.engine.render(renderer, source, stream, max_pages, batch),
+                    key=key,
+                    priority=priority,
+                    user_id=ctx.author.id,
+                    guild_id=ctx.guild and ctx.guild.id,
+                ),
+            )
+        except BaseException:
+            if stream is not None:
+                stream.close()
+            raise
+        if stream is not None:
+            stream.finish(result)
+        return result
 
     async def get_default_renderer(self, message: discord.Message):
         default_renderer = await self.bot.database.pool.fetchval(
@@ -235,36 +1294,120 @@ class Math(commands.Cog):
         except KeyError:
             return self.renderer_by_key[DEFAULT_DEFAULT_RENDERER]
 
+    async def get_prefetch(self, user: discord.abc.User) -> bool:
+        if (prefetch := self.prefetch_settings.get(user.id)) is not None:
+            return prefetch
+        prefetch = await self.bot.database.pool.fetchval(
+            """
+                SELECT prefetch
+                FROM math_settings
+                WHERE user_id = $1
+            """,
+            user.id,
+        )
+        self.prefetch_settings[user.id] = bool(prefetch)
+        return bool(prefetch)
+
     @commands.Cog.listener()
-    async def on_message(self, message):
-        if message.author.bot:
-            return
-        ctx = await self.bot.get_context(message)
-        if ctx.command is not None:
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        if (view := self.speculating.get(payload.message_id)) is not None:
+            view.cancel_speculation()
+            view.stop()
+        if (reply := self.replies.pop(payload.message_id, None)) is not None:
+            # The message the reply was rendered from is gone, so it can't be edited any more.
+            reply.view.cancel_speculation()
+            if (task := self.pending_edits.pop(payload.message_id, None)) is not None:
+                task.cancel()
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        reply = self.replies.get(payload.message_id)
+        # Discord also sends edits when embeds are added, which don't change the content.
+        if reply is None or payload.message.content == reply.content:
             return
+        self.replies[payload.message_id] = reply._replace(content=payload.message.content)
+        if (task := self.pending_edits.pop(payload.message_id, None)) is not None:
+            task.cancel()
+        self.pending_edits[payload.message_id] = asyncio.create_task(
+            self.rerender(payload.message, reply.view)
+        )
 
+    async def rerender(self, message: discord.Message, view: MathView):
+        try:
+            await asyncio.sleep(EDIT_RENDER_DELAY)
+            found = await self.find_math(message)
+            assert view.message is not None
+            if found is None:
+                view.cancel_speculation()
+                view.stop()
+                await view.message.delete()
+                return
+            renderer, source, priority = found
+            source = strip_code_block(source)
+            if source != view.source or renderer is not view.default_renderer:
+                await view.rerender(renderer, source, priority)
+        except RenderQueueFull:
+            pass
+        except discord.NotFound:
+            # The reply was deleted.
+            view.cancel_speculation()
+            view.stop()
+        finally:
+            if self.pending_edits.get(message.id) is asyncio.current_task():
+                del self.pending_edits[message.id]
+
+    async def find_math(
+        self, message: discord.Message
+    ) -> tuple[MathRenderer, str, Priority] | None:
         if match := CODE_BLOCK_RE.search(message.content):
             lang = match.group(1).lower()
             if lang in self.renderer_by_key:
-                renderer = self.renderer_by_key[lang]
-                source = match.group(2).strip()
-                await self.process_math(ctx, renderer, source)
-                return
+                return self.renderer_by_key[lang], match.group(2).strip(), Priority.COMMAND
 
-        if re.search(r"\$.+\$", message.content) is not None:
+        if looks_like_math(message.content):
             renderer = await self.get_default_renderer(message)
-            await self.process_math(ctx, renderer, message.clean_content)
+            return renderer, message.clean_content, Priority.PASSIVE
 
-    @commands.command(aliases=("latex",))
+        return None
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.author.bot:
+            return
+        ctx = await self.bot.get_context(message)
+        if ctx.command is not None:
+            return
+
+        if (found := await self.find_math(message)) is not None:
+            renderer, source, priority = found
+            view = await self.process_math(ctx, renderer, source, priority)
+            if view is not None and not view.is_finished():
+                self.replies[message.id] = MathReply(message.content, view)
+
+    @commands.group(aliases=("latex",), invoke_without_command=True)
     async def tex(self, ctx, file: Optional[discord.Attachment], *, source: str | None = None):
         """Render TeX to an image."""
         await self.process_math_command(ctx, self.renderer_by_key["tex"], file, source)
 
-    @commands.command()
+    @tex.command(name="batch")
+    async def tex_batch(
+        self, ctx, file: Optional[discord.Attachment], *, source: str | None = None
+    ):
+        """Render many TeX snippets, separated by lines of ---, in one go."""
+        await self.process_batch_command(ctx, self.renderer_by_key["tex"], file, source)
+
+    @commands.group(invoke_without_command=True)
     async def typst(self, ctx, file: Optional[discord.Attachment], *, source: str | None = None):
         """Render Typst to an image."""
         await self.process_math_command(ctx, self.renderer_by_key["typst"], file, source)
 
+    @typst.command(name="batch")
+    async def typst_batch(
+        self, ctx, file: Optional[discord.Attachment], *, source: str | None = None
+    ):
+        """Render many Typst snippets, separated by lines of ---, in one go."""
+        await self.process_batch_command(ctx, self.renderer_by_key["typst"], file, source)
+
     @commands.group(invoke_without_command=True)
     async def renderer(self, ctx, renderer: str):
         """Set default math renderer."""
@@ -298,29 +1441,169 @@ class Math(commands.Cog):
         )
         await ctx.send("Unset your default renderer.")
 
-    async def process_math_command(
-        self,
-        ctx: Context,
-        renderer: MathRenderer,
-        file: discord.Attachment | None,
-        source: str | None,
-    ):
+    @renderer.command(name="prefetch")
+    async def renderer_prefetch(self, ctx, enabled: bool):
+        """Render with the other renderer in the background after a compile error."""
+
+        await self.bot.database.pool.execute(
+            """
+                INSERT INTO math_settings (user_id, prefetch)
+                VALUES ($1, $2)
+                ON CONFLICT (user_id) DO UPDATE SET prefetch = EXCLUDED.prefetch
+            """,
+            ctx.author.id,
+            enabled,
+        )
+        self.prefetch_settings[ctx.author.id] = enabled
+        await ctx.send(f"{'Enabled' if enabled else 'Disabled'} background rendering.")
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def mathcache(self, ctx):
+        """View math render cache statistics."""
+
+        cache = self.cache
+        lookups = cache.hits + cache.persistent_hits + cache.misses
+        hit_rate = (cache.hits + cache.persistent_hits) / lookups if lookups else 0
+        await ctx.send(
+            f"**Entries:** {len(cache.entries)} ({cache.size / 1024 / 1024:.1f} / {cache.max_bytes / 1024 / 1024:.0f} MiB)\n"
+            f"**Hits:** {cache.hits} memory, {cache.persistent_hits} persistent ({hit_rate:.1%})\n"
+            f"**Misses:** {cache.misses}\n"
+            f"**Coalesced:** {cache.coalesced}"
+        )
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def mathqueue(self, ctx):
+        """View math render queue statistics."""
+
+        scheduler = self.scheduler
+        p50, p95, p99 = (
+            f"{wait * 1000:.0f} ms" if wait is not None else "n/a"
+            for wait in scheduler.waits.percentiles(50, 95, 99)
+        )
+        await ctx.send(
+            f"**Queued:** {len(scheduler.queued)} / {scheduler.max_queued}\n"
+            f"**Running:** {scheduler.running} / {scheduler.concurrency}\n"
+            f"**Wait:** p50 {p50}, p95 {p95}, p99 {p99} (last {len(scheduler.waits)} of {scheduler.waits.total})\n"
+            f"**Shed:** {scheduler.shed}"
+        )
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def mathstats(self, ctx):
+        """View how long each stage of rendering takes."""
+
+        rows = []
+        for renderer in self.renderers:
+            for stage in RENDER_STAGES:
+                window = self.stats.windows.get((renderer.key, stage))
+                if not window:
+                    continue
+                percentiles = window.percentiles(50, 95, 99)
+                rows.append(
+                    [renderer.name, stage, window.total, *(f"{p * 1000:.1f}" for p in percentiles)]
+                )
+        if not rows:
+            return await ctx.send("Nothing has been rendered yet.")
+
+        table = formats.TabularData()
+        table.set_columns(["Renderer", "Stage", "Count", "p50 (ms)", "p95 (ms)", "p99 (ms)"])
+        table.add_rows(rows)
+        await ctx.send(f"```\n{table.render()}\n```")
+
+    async def read_source(
+        self, ctx: Context, file: discord.Attachment | None, source: str | None
+    ) -> str:
         if file is not None and source is not None:
             raise commands.TooManyArguments("Cannot pass both a source string and a file!")
         elif file is not None:
             source_bytes = await file.read()
-            await self.process_math(ctx, renderer, source_bytes.decode("utf-8"))
+            return source_bytes.decode("utf-8")
         elif source is not None:
-            await self.process_math(ctx, renderer, source)
+            return source
         else:
             assert ctx.command is not None
             raise commands.MissingRequiredArgument(ctx.command.clean_params["source"])
 
-    async def process_math(self, ctx: Context, renderer: MathRenderer, source: str):
+    async def process_math_command(
+        self,
+        ctx: Context,
+        renderer: MathRenderer,
+        file: discord.Attachment | None,
+        source: str | None,
+    ):
+        await self.process_math(ctx, renderer, await self.read_source(ctx, file, source))
+
+    async def process_batch_command(
+        self,
+        ctx: Context,
+        renderer: MathRenderer,
+        file: discord.Attachment | None,
+        source: str | None,
+    ):
+        snippets = split_snippets(strip_code_block(await self.read_source(ctx, file, source)))
+        if not snippets:
+            raise commands.BadArgument("There are no snippets to render.")
+        if len(snippets) > MAX_BATCH_SNIPPETS:
+            raise commands.BadArgument(
+                f"Can only render {MAX_BATCH_SNIPPETS} snippets at once, not {len(snippets)}."
+            )
+
+        # All snippets are compiled as one document, so a batch costs a single compile and a
+        # single slot in the queue however many snippets it has.
+        source = renderer.join_snippets(snippets)
+        stream = PageStream()
+        rendering = asyncio.create_task(
+            self.render(ctx, renderer, source, Priority.COMMAND, stream, len(snippets), batch=True)
+        )
+        files = []
+        try:
+            async with ctx.typing():
+                async for page in stream:
+                    files.append(
+                        discord.File(io.BytesIO(page), filename=f"snippet_{len(files) + 1}.png")
+                    )
+                    if len(files) % MAX_FILES_PER_MESSAGE == 0:
+                        await ctx.send(files=files[-MAX_FILES_PER_MESSAGE:])
+                await rendering
+        except CompileError as e:
+            error = str(e)
+            if (index := renderer.failed_snippet(source, error)) is not None:
+                where = f"Snippet {index} of {len(snippets)} didn't compile."
+            else:
+                where = "The snippets didn't compile."
+            await ctx.send(f"**{ctx.author}**\n{where}\n```{error[:1850]}```")
+            return
+        except RenderQueueFull:
+            await ctx.reply(RENDER_BUSY_MESSAGE, delete_after=15, mention_author=False)
+            return
+        finally:
+            rendering.cancel()
+
+        notes = list(stream.notes)
+        if len(files) != len(snippets):
+            notes.append(f"Rendered {len(files)} pages for {len(snippets)} snippets.")
+        remaining = files[len(files) - len(files) % MAX_FILES_PER_MESSAGE :]
+        if remaining or notes:
+            await ctx.send("\n".join(notes) or None, files=remaining)
+
+    async def process_math(
+        self,
+        ctx: Context,
+        renderer: MathRenderer,
+        source: str,
+        priority: Priority = Priority.COMMAND,
+    ) -> MathView | None:
         source = strip_code_block(source)
-        async with ctx.typing():
-            view = MathView(ctx, source, renderer, self.renderers)
-            await view.send(ctx.channel)
+        try:
+            async with ctx.typing():
+                view = MathView(self, ctx, source, renderer, self.renderers, priority)
+                await view.send(ctx.channel)
+        except RenderQueueFull:
+            await ctx.reply(RENDER_BUSY_MESSAGE, delete_after=15, mention_author=False)
+            return None
+        return view
 
 
 async def setup(bot):
@@ -1,19 +1,220 @@
 import asyncio
+import datetime
+import heapq
+import logging
+import itertools
+import json
+import os
+import socket
 import textwrap
 import discord
-from typing import Annotated, NamedTuple
-from asyncpg import Record
-from discord.ext import commands
+from collections import Counter, defaultdict
+from enum import Enum
+from typing import Annotated, Awaitable, Callable, Sequence
+from asyncpg import Connection, Pool, Record
+from discord.ext import commands, tasks
 from discord.ext.menus.views import ViewMenuPages
 
 from bmt_discord_bot import Bot, Context
-from bmt_discord_bot.lib import formats, time
-from bmt_discord_bot.lib.pagination import EmbedFieldsPageSource
-
-
-class DispatchedReminder(NamedTuple):
-    reminder: Record
-    task: asyncio.Task
+from bmt_discord_bot.lib import formats, recurrence, time
+from bmt_discord_bot.lib.pagination import EmbedFieldsKeysetPageSource
+from bmt_discord_bot.lib.stats import RollingWindow
+
+
+REMINDER_COLUMNS = "id, user_id, event, guild_id, channel_id, message_id, created_at, expires_at, mention_everyone, mention_role_ids, recurrence"
+# The most pending reminders loaded into memory at once.
+REMINDER_WINDOW_SIZE = 1000
+# The most reminders sent at the same time. discord.py waits out rate limits on its own, this only
+# keeps a burst of reminders from all waiting on the same bucket at once.
+REMINDER_SEND_CONCURRENCY = 10
+# Reminders that came due while the bot was down are sent at this many messages per second, so
+# that a long backlog doesn't run into Discord's rate limits.
+REMINDER_CATCH_UP_RATE = 5
+# Whether overdue reminders for the same user in the same channel are sent as one message, and how
+# many reminders one such message can list.
+REMINDER_CATCH_UP_CONSOLIDATE = True
+REMINDER_CATCH_UP_DIGEST_SIZE = 10
+# How long a process has to send the reminders it claimed before another one may take them over.
+REMINDER_LEASE_DURATION = datetime.timedelta(minutes=5)
+# Resolved reminders are moved to reminders_archive once they're this old, in batches of this
+# many, and deleted from there after the retention period.
+REMINDER_ARCHIVE_AFTER_DAYS = 30
+REMINDER_ARCHIVE_BATCH_SIZE = 10_000
+REMINDER_ARCHIVE_RETENTION_DAYS = 365
+# How long the scheduler waits before trying again when dispatching reminders fails.
+REMINDER_RETRY_DELAY = datetime.timedelta(seconds=10)
+# The watchdog restarts the scheduler if a reminder is this overdue without being dispatched.
+REMINDER_STALL_THRESHOLD = datetime.timedelta(minutes=2)
+# Channel that the reminders table notifies of inserted and deleted reminders on.
+REMINDER_CHANNEL = "reminders"
+
+
+class SendResult(Enum):
+    SENT = "sent"
+    # The channel or message is gone, or the request was rejected, so trying again won't help.
+    FAILED = "failed"
+    # Discord had trouble on its end, so the reminder is left to be sent again later.
+    RETRY = "retry"
+
+
+class ReminderScheduler:
+    """Dispatches reminders as they come due, holding the earliest pending ones in a heap.
+
+    The heap holds every pending reminder up to the horizon, in (expires_at, id) order, and the
+    next window after it is only loaded once the heap runs dry. Reminders created before the
+    horizon are pushed onto the heap, and deleted ones are skipped when they reach the top, so
+    neither needs a query. Only IDs and times are kept; the rest of a reminder is read when it is
+    claimed for dispatch.
+    """
+
+    def __init__(
+        self,
+        pool: Pool,
+        dispatch: Callable[[list[int]], Awaitable[None]],
+        *,
+        window_size: int = REMINDER_WINDOW_SIZE,
+    ):
+        self.pool = pool
+        self.dispatch = dispatch
+        self.window_size = window_size
+        self.wakeup = asyncio.Event()
+        # When the batch being dispatched right now was popped, if there is one.
+        self.dispatching_since: datetime.datetime | None = None
+        self.logger = logging.getLogger(__name__)
+        self.reset()
+
+    def __len__(self):
+        return len(self.reminders)
+
+    def reset(self):
+        """Forgets everything loaded so far, so that the next window is read from scratch."""
+
+        self.heap: list[tuple[datetime.datetime, int]] = []
+        self.reminders: dict[int, datetime.datetime] = {}
+        self.horizon = (datetime.datetime.min.replace(tzinfo=datetime.timezone.utc), 0)
+        # Whether the heap holds every pending reminder, i.e. there is nothing past the horizon.
+        self.complete = False
+        # Reminders added past the horizon while a window is being read, which the read may have
+        # missed, or None if no window is being read.
+        self.arrived: dict[int, datetime.datetime] | None = None
+        self.wakeup.set()
+
+    def add(self, id: int, expires_at: datetime.datetime):
+        key = (expires_at, id)
+        if self.reminders.get(id) == expires_at:
+            return
+        if not self.complete and key > self.horizon:
+            # If it moved past the horizon, it's loaded again along with the window it's now in.
+            self.reminders.pop(id, None)
+            if self.arrived is not None:
+                self.arrived[id] = expires_at
+            return
+        self.reminders[id] = expires_at
+        heapq.heappush(self.heap, key)
+        if self.heap[0] == key:
+            self.wakeup.set()
+
+    def discard(self, ids: list[int]):
+        for id in ids:
+            self.reminders.pop(id, None)
+            if self.arrived is not None:
+                self.arrived.pop(id, None)
+        if self.heap and self.heap[0][1] in ids:
+            self.wakeup.set()
+
+    def peek(self) -> datetime.datetime | None:
+        """When the next reminder on the heap is due."""
+
+        while self.heap and self.is_stale(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def is_stale(self, key: tuple[datetime.datetime, int]) -> bool:
+        expires_at, id = key
+        return self.reminders.get(id) != expires_at
+
+    async def refill(self):
+        # The window is read from a snapshot taken when the query starts, so reminders added
+        # while it runs are held on to until the new horizon is known, and then added against it.
+        arrived = self.arrived = {}
+        try:
+            reminders = await self.pool.fetch(
+                """
+                    SELECT id, expires_at
+                    FROM reminders
+                    WHERE NOT is_resolved AND (expires_at, id) > ($1::timestamptz, $2::bigint)
+                    ORDER BY expires_at, id
+                    LIMIT $3
+                """,
+                *self.horizon,
+                self.window_size,
+            )
+        finally:
+            was_reset = self.arrived is not arrived
+            if not was_reset:
+                self.arrived = None
+        if was_reset:
+            # Everything was forgotten while the window was read, so it's out of date.
+            return
+        for reminder in reminders:
+            if reminder["id"] not in self.reminders:
+                self.reminders[reminder["id"]] = reminder["expires_at"]
+                heapq.heappush(self.heap, (reminder["expires_at"], reminder["id"]))
+        if len(reminders) < self.window_size:
+            self.complete = True
+        else:
+            self.horizon = (reminders[-1]["expires_at"], reminders[-1]["id"])
+        for id, expires_at in arrived.items():
+            self.add(id, expires_at)
+
+    def pop_due(self) -> list[tuple[datetime.datetime, int]]:
+        now = discord.utils.utcnow()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            key = heapq.heappop(self.heap)
+            if not self.is_stale(key):
+                del self.reminders[key[1]]
+                due.append(key)
+        return due
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if self.peek() is None:
+                if self.complete:
+                    await self.wakeup.wait()
+                else:
+                    await self.refill()
+                continue
+
+            delay = (self.heap[0][0] - discord.utils.utcnow()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except TimeoutError:
+                    pass
+                continue
+
+            self.dispatching_since = discord.utils.utcnow()
+            due = self.pop_due()
+            try:
+                await self.dispatch([id for _, id in due])
+            except Exception:
+                self.logger.exception("Could not dispatch reminders, trying again shortly")
+                # Reminders that failed before they were claimed have no lease to run out, and
+                # are behind the horizon, so nothing else would ever load them again. Ones that
+                # were claimed are skipped until lease recovery puts them back.
+                for expires_at, id in due:
+                    self.add(id, expires_at)
+                await asyncio.sleep(REMINDER_RETRY_DELAY.total_seconds())
+            finally:
+                self.dispatching_since = None
+
+
+def exit_reason(task: asyncio.Task) -> str:
+    if not task.cancelled() and task.exception():
+        return f"its task failed with {task.exception()!r}"
+    return "its task exited"
 
 
 class Reminders(commands.Cog):
@@ -21,8 +222,280 @@ class Reminders(commands.Cog):
 
     def __init__(self, bot: Bot):
         self.bot = bot
-        self._current: DispatchedReminder | None = None
-        self.bot.loop.create_task(self.update_current())
+        self.scheduler = ReminderScheduler(bot.database.pool, self.dispatch_reminders)
+        self.send_semaphore = asyncio.Semaphore(REMINDER_SEND_CONCURRENCY)
+        # Identifies this process in the leases it takes out, when several share the database.
+        self.instance = f"{socket.gethostname()}:{os.getpid()}"
+        # How late scheduled reminders go out, in seconds, and how sends turn out.
+        self.lateness = RollingWindow()
+        self.outcomes: Counter[str] = Counter()
+        self.restarts = 0
+        self.logger = logging.getLogger(__name__)
+
+    async def cog_load(self):
+        self.catch_up_task: asyncio.Task | None = None
+        self.listener: Connection | None = None
+        self.scheduler_task = asyncio.create_task(self.run_scheduler())
+        self.recover_task = asyncio.create_task(self.recover_leases())
+        self.archive_reminders.start()
+        self.watchdog.start()
+
+    async def cog_unload(self):
+        self.watchdog.cancel()
+        self.scheduler_task.cancel()
+        self.recover_task.cancel()
+        self.archive_reminders.cancel()
+        if self.catch_up_task is not None:
+            self.catch_up_task.cancel()
+        await self.unlisten()
+
+    async def run_scheduler(self):
+        await self.bot.wait_until_ready()
+        await self.listen()
+        # Only one backlog is sent at a time, so that they don't add up to more than the catch-up
+        # rate. Whatever the last one hadn't got to yet is released when it stops, and claimed
+        # again below.
+        if self.catch_up_task is not None:
+            self.catch_up_task.cancel()
+            await asyncio.wait([self.catch_up_task])
+        # Reminders that came due while the bot was down are leased up front, for long enough to
+        # send all of them at the catch-up rate, so the scheduler can get on with new ones while
+        # the backlog is sent. Each one is resolved once it has been sent, and any left over if
+        # the process stops partway through are picked up by lease recovery. Ones another
+        # process has leased are left to it, and recurring ones to the scheduler, which moves
+        # them on to their next occurrence.
+        overdue = await self.bot.database.pool.fetch(
+            f"""
+                WITH overdue AS (
+                    SELECT id
+                    FROM reminders
+                    WHERE NOT is_resolved AND expires_at <= $1 AND recurrence IS NULL
+                        AND (leased_until IS NULL OR leased_until < NOW())
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE reminders
+                SET leased_until = NOW() + $2::interval
+                        + (SELECT COUNT(*) FROM overdue) * $3::interval,
+                    leased_by = $4
+                WHERE id IN (SELECT id FROM overdue)
+                RETURNING {REMINDER_COLUMNS}
+            """,
+            discord.utils.utcnow(),
+            REMINDER_LEASE_DURATION,
+            datetime.timedelta(seconds=1 / REMINDER_CATCH_UP_RATE),
+            self.instance,
+        )
+        if overdue:
+            self.catch_up_task = asyncio.create_task(self.catch_up(overdue))
+        await self.scheduler.run()
+
+    async def listen(self):
+        """Holds a connection listening for reminders created or deleted by any process, including
+        this one, so that every scheduler sharing the database hears about them.
+        """
+
+        self.listener = await self.bot.database.pool.acquire()
+        await self.listener.add_listener(REMINDER_CHANNEL, self.on_notification)
+        self.listener.add_termination_listener(self.on_listener_terminated)
+
+    async def unlisten(self):
+        if self.listener is not None:
+            listener, self.listener = self.listener, None
+            listener.remove_termination_listener(self.on_listener_terminated)
+            if not listener.is_closed():
+                await listener.remove_listener(REMINDER_CHANNEL, self.on_notification)
+            await self.bot.database.pool.release(listener)
+
+    def on_notification(self, connection: Connection, pid: int, channel: str, payload: str):
+        notification = json.loads(payload)
+        if notification["op"] == "DELETE":
+            self.scheduler.discard([notification["id"]])
+        else:
+            expires_at = datetime.datetime.fromisoformat(notification["expires_at"])
+            self.scheduler.add(notification["id"], expires_at)
+
+    def on_listener_terminated(self, connection: Connection):
+        self.logger.warning("Lost the reminder notification connection, reconnecting")
+        self.bot.loop.create_task(self.relisten())
+
+    async def relisten(self):
+        await self.unlisten()
+        await self.listen()
+        # Anything could have changed while nothing was listening, so start over from the
+        # database.
+        self.scheduler.reset()
+
+    async def recover_leases(self):
+        """Puts reminders back on the heap whose lease ran out before they were sent, e.g. because
+        the process that claimed them crashed.
+        """
+
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(REMINDER_LEASE_DURATION.total_seconds())
+            try:
+                expired = await self.bot.database.pool.fetch(
+                    """
+                        SELECT id, expires_at
+                        FROM reminders
+                        WHERE NOT is_resolved AND leased_until < NOW()
+                    """
+                )
+            except Exception:
+                self.logger.exception("Could not look for expired reminder leases")
+                continue
+            for reminder in expired:
+                self.scheduler.add(reminder["id"], reminder["expires_at"])
+
+    async def catch_up(self, reminders: Sequence[Record]):
+        start = discord.utils.utcnow()
+        reminders = sorted(reminders, key=lambda r: (r["expires_at"], r["id"]))
+        groups: dict[tuple[int, ...], list[Record]] = defaultdict(list)
+        for reminder in reminders:
+            if REMINDER_CATCH_UP_CONSOLIDATE:
+                groups[reminder["user_id"], reminder["channel_id"]].append(reminder)
+            else:
+                groups[reminder["id"],].append(reminder)
+        batches = [
+            batch
+            for group in groups.values()
+            for batch in itertools.batched(group, REMINDER_CATCH_UP_DIGEST_SIZE)
+        ]
+
+        sends = []
+        try:
+            for batch in batches:
+                sends.append(asyncio.create_task(self.send_overdue(batch)))
+                await asyncio.sleep(1 / REMINDER_CATCH_UP_RATE)
+        except asyncio.CancelledError:
+            # Messages already being sent are left to finish.
+            await self.release_leases([r["id"] for batch in batches[len(sends) :] for r in batch])
+            raise
+        await asyncio.wait(sends)
+        for batch, send in zip(batches, sends):
+            if send.exception() is not None:
+                self.logger.error(
+                    f"Could not catch up on reminders {[r['id'] for r in batch]}",
+                    exc_info=send.exception(),
+                )
+
+        elapsed = (discord.utils.utcnow() - start).total_seconds()
+        late = (start - reminders[0]["expires_at"]).total_seconds()
+        self.logger.info(
+            f"Caught up on {len(reminders)} overdue reminders in {len(batches)} messages, "
+            f"taking {elapsed:.1f}s; the oldest was {late:.0f}s overdue"
+        )
+
+    async def release_leases(self, ids: Sequence[int]):
+        """Gives up this process's leases on reminders it hasn't sent, so that they can be claimed
+        again without waiting for the leases to run out.
+        """
+
+        if not ids:
+            return
+        try:
+            await self.bot.database.pool.execute(
+                """
+                    UPDATE reminders
+                    SET leased_until = NULL
+                    WHERE id = ANY($1::bigint[]) AND leased_by = $2 AND NOT is_resolved
+                """,
+                ids,
+                self.instance,
+            )
+        except Exception:
+            self.logger.exception(f"Could not release reminders {ids}, leaving them to recovery")
+
+    async def send_overdue(self, reminders: Sequence[Record]):
+        if len(reminders) == 1:
+            result = await self.send_reminder(reminders[0], scheduled=False)
+        else:
+            result = await self.send_digest(reminders)
+        await self.resolve_reminders(reminders, [result] * len(reminders))
+
+    @tasks.loop(minutes=1)
+    async def watchdog(self):
+        """Restarts the scheduler if its task has died or it has stopped dispatching reminders, and
+        lease recovery if its task has died.
+        """
+
+        if self.recover_task.done():
+            self.logger.error(
+                f"Restarting reminder lease recovery, since {exit_reason(self.recover_task)}"
+            )
+            self.recover_task = asyncio.create_task(self.recover_leases())
+
+        now = discord.utils.utcnow()
+        head = self.scheduler.peek()
+        dispatching_since = self.scheduler.dispatching_since
+        if self.scheduler_task.done():
+            reason = exit_reason(self.scheduler_task)
+        elif dispatching_since is not None:
+            if now - dispatching_since < REMINDER_LEASE_DURATION:
+                return
+            reason = f"it has been dispatching since {dispatching_since}"
+        elif head is not None and now - head > REMINDER_STALL_THRESHOLD:
+            reason = f"a reminder due at {head} hasn't been dispatched"
+        elif self.listener is None or self.listener.is_closed():
+            reason = "it isn't listening for notifications"
+        else:
+            return
+
+        self.logger.error(f"Restarting the reminder scheduler, since {reason}")
+        self.restarts += 1
+        self.scheduler_task.cancel()
+        # The backlog it was catching up on goes with it; the new one claims what's left of it.
+        if self.catch_up_task is not None:
+            self.catch_up_task.cancel()
+        await self.unlisten()
+        self.scheduler.reset()
+        self.scheduler_task = asyncio.create_task(self.run_scheduler())
+
+    @watchdog.before_loop
+    async def before_watchdog(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(hours=24)
+    async def archive_reminders(self):
+        """Keeps the reminders table down to pending and recently resolved reminders."""
+
+        # An exception escaping the loop would stop it for good, so a failed run is only logged,
+        # and what it didn't get to is archived by the next one.
+        try:
+            await self.archive()
+        except Exception:
+            self.logger.exception("Could not archive resolved reminders")
+
+    async def archive(self):
+        while True:
+            result = await self.bot.database.pool.execute(
+                """
+                    WITH archived AS (
+                        DELETE FROM reminders
+                        WHERE id IN (
+                            SELECT id
+                            FROM reminders
+                            WHERE is_resolved AND expires_at < NOW() - make_interval(days => $1)
+                            LIMIT $2
+                        )
+                        RETURNING *
+                    )
+                    INSERT INTO reminders_archive
+                    SELECT * FROM archived
+                """,
+                REMINDER_ARCHIVE_AFTER_DAYS,
+                REMINDER_ARCHIVE_BATCH_SIZE,
+            )
+            if int(result.removeprefix("INSERT 0 ")) < REMINDER_ARCHIVE_BATCH_SIZE:
+                break
+
+        await self.bot.database.pool.execute(
+            """
+                DELETE FROM reminders_archive
+                WHERE expires_at < NOW() - make_interval(days => $1)
+            """,
+            REMINDER_ARCHIVE_RETENTION_DAYS,
+        )
 
     @commands.hybrid_group(aliases=("remind", "remindme"), usage="<when> [event]", fallback="set")
     async def reminder(
@@ -43,28 +516,66 @@ class Reminders(commands.Cog):
         Times are parsed as US Pacific Time.
         """
 
+        await self.create_reminder(ctx, time_and_content.dt, time_and_content.arg)
+
+    @reminder.command(usage="<recurrence> <when> [event]")
+    async def every(
+        self,
+        ctx: Context,
+        rule: Annotated[str, recurrence.Recurrence],
+        *,
+        time_and_content: Annotated[
+            time.FriendlyTimeResult,
+            time.UserFriendlyTime(default="\u2026"),
+        ],
+    ):
+        """Sets a reminder that repeats, starting from a date or duration of time, e.g.:
+
+        • weekly next monday 9am team meeting
+        • weekdays tomorrow 8am standup
+        • "0 18 * * FRI" friday submit timesheets
+
+        Repeats can be hourly, daily, weekdays, weekly, biweekly, monthly or yearly, a quoted cron
+        expression or an RRULE. Times are parsed as US Pacific Time.
+        """
+
+        series = recurrence.series(rule, time_and_content.dt)
+        first = await asyncio.to_thread(recurrence.validate, series)
+        if first is None:
+            raise commands.BadArgument("That never happens.")
+        await self.create_reminder(ctx, first, time_and_content.arg, series)
+
+    async def create_reminder(
+        self,
+        ctx: Context,
+        when: datetime.datetime,
+        event: str,
+        series: str | None = None,
+    ):
         mention_everyone = ctx.message.mention_everyone
         mention_role_ids = [r.id for r in ctx.message.role_mentions]
 
         reminder = await ctx.bot.database.pool.fetchrow(
-            """
-                INSERT INTO reminders (user_id, event, guild_id, channel_id, message_id, created_at, expires_at, mention_everyone, mention_role_ids)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-                RETURNING id, user_id, event, channel_id, message_id, created_at, expires_at, mention_everyone, mention_role_ids
+            f"""
+                INSERT INTO reminders (user_id, event, guild_id, channel_id, message_id, created_at, expires_at, mention_everyone, mention_role_ids, recurrence)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+                RETURNING {REMINDER_COLUMNS}
             """,
             ctx.author.id,
-            time_and_content.arg,
+            event,
             ctx.guild and ctx.guild.id,
             ctx.channel.id,
             ctx.message.id,
             ctx.message.created_at,
-            time_and_content.dt,
+            when,
             mention_everyone,
             mention_role_ids,
+            series,
         )
-        self.bot.loop.create_task(self.update_current(reminder))
+        self.scheduler.add(reminder["id"], reminder["expires_at"])
+        repeats = " and then every time it repeats" if series is not None else ""
         await ctx.send(
-            f"Alright, I'll remind you in **{time.human_timedelta(time_and_content.dt, source=ctx.message.created_at)}**: {time_and_content.arg}",
+            f"Alright, I'll remind you in **{time.human_timedelta(when, source=ctx.message.created_at)}**{repeats}: {event}",
             allowed_mentions=discord.AllowedMentions.none(),
         )
 
@@ -73,30 +584,29 @@ class Reminders(commands.Cog):
     async def list(self, ctx: Context):
         """Lists future reminders set by you."""
 
-        reminders = await ctx.bot.database.pool.fetch(
+        def format_item(i, x):
+            name = f"{x['id']}. {discord.utils.format_dt(x['expires_at'], 'R')}"
+            if x["recurrence"] is not None:
+                name += " (repeats)"
+            return {"name": name, "value": textwrap.shorten(x["event"], 512), "inline": False}
+
+        source = EmbedFieldsKeysetPageSource(
+            ctx.bot.database.pool,
             """
-                SELECT id, event, expires_at
+                SELECT id, event, expires_at, recurrence
                 FROM reminders
                 WHERE user_id = $1 AND NOT is_resolved
-                ORDER BY expires_at
             """,
             ctx.author.id,
+            key=("expires_at", "id"),
+            title="Reminders",
+            format_item=format_item,
         )
-
-        def format_item(i, x):
-            name = f"{x['id']}. {discord.utils.format_dt(x['expires_at'], 'R')}"
-            return {"name": name, "value": textwrap.shorten(x["event"], 512), "inline": False}
-
-        if not reminders:
+        await source.prepare()
+        if not source.count:
             return await ctx.send("No reminders found.")
 
-        pages = ViewMenuPages(
-            source=EmbedFieldsPageSource(
-                reminders,
-                title="Reminders",
-                format_item=format_item,
-            )
-        )
+        pages = ViewMenuPages(source=source)
         await pages.start(ctx)
 
     @reminder.command(aliases=("del",))
@@ -104,73 +614,99 @@ class Reminders(commands.Cog):
     async def delete(self, ctx: Context, ids: commands.Greedy[int]):
         """Deletes one or more reminders."""
 
-        result = await ctx.bot.database.pool.execute(
+        deleted = await ctx.bot.database.pool.fetch(
             """
                 DELETE
                 FROM reminders
                 WHERE user_id = $1 AND ID = ANY($2::int[])
+                RETURNING id
             """,
             ctx.author.id,
             ids,
         )
-        num_deleted = int(result.removeprefix("DELETE "))
-        self.clear_current()
-        self.bot.loop.create_task(self.update_current())
-        await ctx.send(f"Successfully deleted {formats.plural(num_deleted):reminder}.")
-
-    async def get_next_reminder(self):
-        return await self.bot.database.pool.fetchrow(
-            """
-            SELECT id, user_id, event, channel_id, message_id, created_at, expires_at, mention_everyone, mention_role_ids
-            FROM reminders
-            WHERE NOT is_resolved
-            ORDER BY expires_at
-            LIMIT 1
-            """
+        self.scheduler.discard([r["id"] for r in deleted])
+        await ctx.send(f"Successfully deleted {formats.plural(len(deleted)):reminder}.")
+
+    async def dispatch_reminders(self, ids: Sequence[int]):
+        # Every scheduler sharing the database has the same reminders on its heap, so they are
+        # leased first and only sent by whichever process gets them. Rows another process is in
+        # the middle of claiming are skipped rather than waited on.
+        reminders = await self.bot.database.pool.fetch(
+            f"""
+                UPDATE reminders
+                SET leased_until = NOW() + $2::interval, leased_by = $3
+                WHERE id IN (
+                    SELECT id
+                    FROM reminders
+                    WHERE id = ANY($1::bigint[]) AND NOT is_resolved
+                        AND (leased_until IS NULL OR leased_until < NOW())
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING {REMINDER_COLUMNS}
+            """,
+            ids,
+            REMINDER_LEASE_DURATION,
+            self.instance,
         )
+        if not reminders:
+            return
+        results = await asyncio.gather(*map(self.send_reminder, reminders))
+        await self.resolve_reminders(reminders, results)
 
-    def clear_current(self):
-        if self._current:
-            self._current.task.cancel()
-            self._current = None
-
-    async def update_current(self, reminder=None):
-        await self.bot.wait_until_ready()
-
-        if reminder is None:
-            reminder = await self.get_next_reminder()
-            if reminder is None:
-                return
-
-        if self._current is not None and not self._current.task.done():
-            if reminder["expires_at"] > self._current.reminder["expires_at"]:
-                return
-            self.clear_current()
+    async def resolve_reminders(self, reminders: Sequence[Record], results: Sequence[SendResult]):
+        """Records how sending reminders leased by this process went, and releases the leases.
 
-        self._current = DispatchedReminder(
-            reminder=reminder,
-            task=self.bot.loop.create_task(self.dispatch_reminder(reminder)),
-        )
+        Recurring reminders move on to their next occurrence instead of being resolved, unless
+        the series is over or its channel is gone. Missed occurrences are skipped. Reminders to
+        retry keep their lease, so that lease recovery sends them again once it runs out.
+        """
 
-    async def dispatch_reminder(self, reminder):
-        try:
-            await discord.utils.sleep_until(reminder["expires_at"])
-        except asyncio.CancelledError:
+        finished = [
+            (r, result) for r, result in zip(reminders, results) if result != SendResult.RETRY
+        ]
+        if not finished:
             return
-
+        reminders = [r for r, _ in finished]
+        sent = [result == SendResult.SENT for _, result in finished]
+        now = discord.utils.utcnow()
+        following = await asyncio.to_thread(
+            lambda: [
+                recurrence.next_occurrence(r["recurrence"], max(r["expires_at"], now))
+                if r["recurrence"] is not None and ok
+                else None
+                for r, ok in zip(reminders, sent)
+            ]
+        )
         await self.bot.database.pool.execute(
-            "UPDATE reminders SET is_resolved = True WHERE id = $1",
-            reminder["id"],
+            """
+                UPDATE reminders
+                SET is_resolved = outcome.expires_at IS NULL,
+                    is_failed = NOT outcome.sent,
+                    expires_at = COALESCE(outcome.expires_at, reminders.expires_at),
+                    leased_until = NULL
+                FROM unnest($1::bigint[], $2::boolean[], $3::timestamptz[])
+                    AS outcome (id, sent, expires_at)
+                WHERE reminders.id = outcome.id AND reminders.leased_by = $4
+            """,
+            [r["id"] for r in reminders],
+            sent,
+            following,
+            self.instance,
         )
+        for reminder, expires_at in zip(reminders, following):
+            if expires_at is not None:
+                self.scheduler.add(reminder["id"], expires_at)
+
+    async def send_reminder(self, reminder: Record, *, scheduled: bool = True) -> SendResult:
+        """Sends a reminder as a reply to the message that set it. Only scheduled sends count
+        towards lateness, since ones caught up on after downtime are late by however long the bot
+        was down.
+        """
 
-        channel = self.bot.get_partial_messageable(reminder["channel_id"])
+        channel = self.bot.get_partial_messageable(
+            reminder["channel_id"], guild_id=reminder["guild_id"]
+        )
         text = f"Reminder from {discord.utils.format_dt(reminder['created_at'], 'R')}: {reminder['event']}"
-        try:
-            reference = await channel.fetch_message(reminder["message_id"])
-        except (discord.NotFound, discord.Forbidden, discord.HTTPException):
-            text = f"<@{reminder['user_id']}> {text}"
-            reference = None
-
         allowed_mentions = discord.AllowedMentions(
             everyone=reminder["mention_everyone"],
             roles=[discord.Object(id=r) for r in reminder["mention_role_ids"]],
@@ -178,15 +714,87 @@ class Reminders(commands.Cog):
             replied_user=True,
         )
 
-        try:
-            await channel.send(text, reference=reference, allowed_mentions=allowed_mentions)
-        except (discord.NotFound, discord.Forbidden):
-            return await self.bot.database.pool.execute(
-                "UPDATE reminders SET is_failed = True WHERE id = $1",
-                reminder["id"],
-            )
+        async with self.send_semaphore:
+            try:
+                try:
+                    # The reference is built from the stored IDs rather than fetched, which
+                    # leaves it to Discord to reject it if the message is gone.
+                    reference = channel.get_partial_message(reminder["message_id"])
+                    await channel.send(text, reference=reference, allowed_mentions=allowed_mentions)
+                    self.outcomes["sent"] += 1
+                except discord.HTTPException as e:
+                    if e.status != 400:
+                        raise
+                    text = f"<@{reminder['user_id']}> {text}"
+                    await channel.send(text, allowed_mentions=allowed_mentions)
+                    self.outcomes["sent without reply"] += 1
+            except (discord.NotFound, discord.Forbidden) as e:
+                self.outcomes[type(e).__name__] += 1
+                return SendResult.FAILED
+            except discord.HTTPException as e:
+                self.logger.exception(f"Could not send reminder {reminder['id']}")
+                return self.send_failed(e)
+        if scheduled:
+            self.lateness.add((discord.utils.utcnow() - reminder["expires_at"]).total_seconds())
+        return SendResult.SENT
+
+    async def send_digest(self, reminders: Sequence[Record]) -> SendResult:
+        """Sends several overdue reminders for the same user and channel in one message."""
+
+        first = reminders[0]
+        channel = self.bot.get_partial_messageable(first["channel_id"], guild_id=first["guild_id"])
+        lines = [f"<@{first['user_id']}> Reminders that came due while I was offline:"]
+        for reminder in reminders:
+            created_at = discord.utils.format_dt(reminder["created_at"], "R")
+            lines.append(f"- From {created_at}: {textwrap.shorten(reminder['event'], 150)}")
+        allowed_mentions = discord.AllowedMentions(
+            everyone=any(r["mention_everyone"] for r in reminders),
+            roles=[discord.Object(id=r) for x in reminders for r in x["mention_role_ids"]],
+            users=True,
+        )
 
-        self.bot.loop.create_task(self.update_current())
+        async with self.send_semaphore:
+            try:
+                await channel.send("\n".join(lines), allowed_mentions=allowed_mentions)
+                self.outcomes["sent"] += 1
+            except (discord.NotFound, discord.Forbidden) as e:
+                self.outcomes[type(e).__name__] += 1
+                return SendResult.FAILED
+            except discord.HTTPException as e:
+                self.logger.exception(f"Could not send reminders {[r['id'] for r in reminders]}")
+                return self.send_failed(e)
+        return SendResult.SENT
+
+    def send_failed(self, error: discord.HTTPException) -> SendResult:
+        # Server errors, and rate limits discord.py gave up waiting out, may well pass. Anything
+        # else Discord rejected would only be rejected again.
+        if error.status >= 500 or error.status == 429:
+            self.outcomes[f"HTTP {error.status}, retrying"] += 1
+            return SendResult.RETRY
+        self.outcomes[f"HTTP {error.status}"] += 1
+        return SendResult.FAILED
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def reminderstats(self, ctx: Context):
+        """View how late reminders go out and how sending them turns out."""
+
+        p50, p95, p99, worst = (
+            f"{late:.2f} s" if late is not None else "n/a"
+            for late in self.lateness.percentiles(50, 95, 99, 100)
+        )
+        sends = sum(self.outcomes.values())
+        failures = sends - self.outcomes["sent"] - self.outcomes["sent without reply"]
+        outcomes = ", ".join(f"{name} {count}" for name, count in self.outcomes.most_common())
+        head = self.scheduler.peek()
+        await ctx.send(
+            f"**Pending in memory:** {len(self.scheduler)}"
+            f"{'' if self.scheduler.complete else ' (more in the database)'}\n"
+            f"**Next due:** {discord.utils.format_dt(head, 'R') if head else 'nothing'}\n"
+            f"**Lateness:** p50 {p50}, p95 {p95}, p99 {p99}, max {worst} (last {len(self.lateness)} of {self.lateness.total})\n"
+            f"**Sends:** {sends}, {failures / sends if sends else 0:.1%} failed ({outcomes or 'none yet'})\n"
+            f"**Scheduler restarts:** {self.restarts}"
+        )
 
 
 async def setup(bot):
@@ -26,6 +26,12 @@ class Database:
         Migration.from_files("0002_math"),
         Migration.from_files("0003_copycat"),
         Migration.from_files("0004_reminder_allowed_mentions"),
+        Migration.from_files("0005_math_render_cache"),
+        Migration.from_files("0006_math_render_cache_notes"),
+        Migration.from_files("0007_math_prefetch"),
+        Migration.from_files("0008_reminder_leases"),
+        Migration.from_files("0009_reminder_indexes"),
+        Migration.from_files("0010_recurring_reminders"),
     ]
 
     def __init__(self, pool: asyncpg.Pool):
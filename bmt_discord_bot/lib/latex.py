@@ -0,0 +1,186 @@
+import os
+import queue
+import re
+import subprocess
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from . import sandbox
+
+# pdflatex only loads its format after reading the first line of input, so a worker can't simply
+# be started without a file and fed one later. Instead the first line reads the job's file name
+# from stdin, which happens after the format has been loaded, and then inputs it in batch mode.
+PRIMED_FIRST_LINE = r"\endlinechar=-1 \read-1 to\bmtjob \endlinechar=13 \batchmode\input{\bmtjob}"
+
+ERROR_CONTEXT_RE = re.compile(r"^l\.\d+ ")
+
+
+class LatexError(Exception):
+    pass
+
+
+def extract_errors(log: str) -> str:
+    """Pulls the error messages and their source context out of a TeX log, roughly like texfot."""
+
+    lines = log.splitlines()
+    errors = []
+    for i, line in enumerate(lines):
+        if not line.startswith("!"):
+            continue
+        for j in range(i, min(i + 20, len(lines))):
+            errors.append(lines[j])
+            if ERROR_CONTEXT_RE.match(lines[j]):
+                if j + 1 < len(lines):
+                    errors.append(lines[j + 1])
+                break
+    return "\n".join(errors or lines[-20:])
+
+
+class LatexFormat:
+    """A pdflatex format file with a fixed preamble already loaded. Cheap to pickle, so a format
+    dumped once can be shared with workers in other processes.
+    """
+
+    def __init__(self, name: str, directory: Path):
+        self.name = name
+        self.directory = directory
+        self.env = os.environ | {"TEXFORMATS": f"{directory}:"}
+
+    @classmethod
+    def dump(cls, name: str, preamble: str, directory: Path) -> "LatexFormat":
+        (directory / f"{name}.tex").write_text(preamble)
+        process = subprocess.run(
+            [
+                "pdflatex",
+                "-ini",
+                "-halt-on-error",
+                f"-jobname={name}",
+                "&pdflatex",
+                rf"{name}.tex\dump",
+            ],
+            cwd=directory,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        if process.returncode != 0 or not (directory / f"{name}.fmt").exists():
+            raise LatexError(extract_errors(process.stdout.decode(errors="replace")))
+        return cls(name, directory)
+
+
+class LatexWorker:
+    """A scratch directory plus a pdflatex process that has loaded a format and is waiting for a
+    job. TeX writes one PDF per run, so every job consumes the process and the next one is primed
+    straight away, with the format the last job used; a job needing a different one pays for a
+    cold start instead. The directory itself is recycled after max_jobs jobs or any failure.
+    """
+
+    def __init__(self, format: LatexFormat, *, max_jobs: int, limits: sandbox.Limits):
+        self.format = format
+        self.max_jobs = max_jobs
+        self.limits = limits
+        self.jobs = 0
+        self.directory: TemporaryDirectory | None = None
+        self.process: subprocess.Popen | None = None
+        self.prime()
+
+    @property
+    def path(self) -> Path:
+        assert self.directory is not None
+        return Path(self.directory.name)
+
+    def prime(self):
+        if self.directory is None:
+            self.directory = TemporaryDirectory(prefix="bmt-tex-")
+            self.jobs = 0
+        for stale in self.path.glob("job.*"):
+            stale.unlink()
+        self.process = sandbox.popen(
+            [
+                "pdflatex",
+                f"-fmt={self.format.name}",
+                "-halt-on-error",
+                "-jobname=job",
+                PRIMED_FIRST_LINE,
+            ],
+            limits=self.limits,
+            cwd=self.path,
+            env=self.format.env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def run(self, body: str, format: LatexFormat | None = None) -> bytes:
+        if format is not None and format.name != self.format.name:
+            self.kill()
+            self.format = format
+            self.prime()
+        assert self.process is not None
+        (self.path / "job.tex").write_text(body)
+        try:
+            sandbox.communicate(self.process, b"job.tex\n", limits=self.limits)
+        except sandbox.LimitExceeded as e:
+            self.recycle()
+            raise LatexError(str(e))
+        self.jobs += 1
+
+        pdf_path = self.path / "job.pdf"
+        if self.process.returncode != 0 or not pdf_path.exists():
+            log_path = self.path / "job.log"
+            log = log_path.read_text(errors="replace") if log_path.exists() else ""
+            returncode = self.process.returncode
+            self.recycle()
+            if returncode is not None and returncode < 0:
+                raise LatexError(sandbox.describe_exit(returncode, self.limits))
+            raise LatexError(extract_errors(log))
+
+        pdf = pdf_path.read_bytes()
+        if self.jobs >= self.max_jobs:
+            self.recycle()
+        else:
+            self.prime()
+        return pdf
+
+    def recycle(self):
+        self.kill()
+        if self.directory is not None:
+            self.directory.cleanup()
+            self.directory = None
+        self.prime()
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            sandbox.kill_group(self.process)
+            self.process.wait()
+        self.process = None
+
+    def close(self):
+        self.kill()
+        if self.directory is not None:
+            self.directory.cleanup()
+            self.directory = None
+
+
+class LatexWorkerPool:
+    """A fixed set of warm workers, which start out with the given format but can compile with any
+    other. Safe to use from several threads.
+    """
+
+    def __init__(self, format: LatexFormat, *, size: int, max_jobs: int, limits: sandbox.Limits):
+        self.format = format
+        self.workers: queue.SimpleQueue[LatexWorker] = queue.SimpleQueue()
+        for _ in range(size):
+            self.workers.put(LatexWorker(format, max_jobs=max_jobs, limits=limits))
+        self.size = size
+
+    def compile(self, body: str, format: LatexFormat | None = None) -> bytes:
+        worker = self.workers.get()
+        try:
+            return worker.run(body, format)
+        finally:
+            self.workers.put(worker)
+
+    def close(self):
+        for _ in range(self.size):
+            self.workers.get().close()
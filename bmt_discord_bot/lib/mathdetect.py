@@ -0,0 +1,60 @@
+import re
+
+CODE_RE = re.compile(r"```.*?```|`[^`\n]*`", re.DOTALL)
+ESCAPED_DOLLAR_RE = re.compile(r"\\\$")
+DISPLAY_RE = re.compile(r"\$\$(.+?)\$\$", re.DOTALL)
+# A dollar sign in front of an amount, like $5, $1,000 or $2.50, followed by the end of a word.
+CURRENCY_RE = re.compile(r"\$\d+(?:[.,]\d+)*[kKmMbB]?(?=[\s.,;!?)/]|$)")
+MATH_CHAR_RE = re.compile(r"[\\^_{}=<>+\-*/|()\[\]!']")
+WORD_RE = re.compile(r"[A-Za-z]{3,}")
+MAX_BARE_TOKEN = 12
+
+
+def looks_like_math(text: str) -> bool:
+    """Cheaply guesses whether a message containing dollar signs is meant to be rendered as math.
+
+    Code spans are ignored, amounts like $5 are treated as currency rather than delimiters, and a
+    message whose dollar signs can't all be paired up is rejected, since it wouldn't compile. At
+    least one delimited span has to look like math rather than prose.
+    """
+
+    text = CODE_RE.sub(" ", text)
+    text = ESCAPED_DOLLAR_RE.sub(" ", text)
+
+    segments = DISPLAY_RE.findall(text)
+    text = DISPLAY_RE.sub(" ", text)
+
+    positions = [m.start() for m in re.finditer(r"\$", text)]
+    i = 0
+    while i < len(positions):
+        start = positions[i]
+        closer = next(
+            (
+                j
+                for j in range(i + 1, len(positions))
+                if not text[positions[j] + 1 : positions[j] + 2].isdigit()
+            ),
+            None,
+        )
+        segment = text[start + 1 : positions[closer]] if closer is not None else None
+        # An amount only opens math if what follows it has actual operators in it, as in $1 + 1$.
+        if CURRENCY_RE.match(text, start) and (segment is None or not MATH_CHAR_RE.search(segment)):
+            i += 1
+            continue
+        if closer is None:
+            return False
+        segments.append(segment)
+        i = closer + 1
+
+    return any(is_mathy(segment) for segment in segments)
+
+
+def is_mathy(segment: str) -> bool:
+    segment = segment.strip()
+    if not segment:
+        return False
+    if MATH_CHAR_RE.search(segment):
+        return True
+    if not any(c.isspace() for c in segment):
+        return len(segment) <= MAX_BARE_TOKEN
+    return len(WORD_RE.findall(segment)) < 2
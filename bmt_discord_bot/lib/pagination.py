@@ -1,13 +1,19 @@
+import asyncio
+from typing import Any, Sequence
+
 import discord
+from asyncpg import Pool, Record
 from discord.ext import menus
 
 
-class EmbedFieldsPageSource(menus.ListPageSource):
-    def __init__(self, data, title=None, format_item=lambda i, x: (i, x)):
-        super().__init__(data, per_page=5)
+class EmbedFieldsMixin:
+    per_page: int
+    count: int | None
+
+    def __init__(self, *args, title=None, format_item=lambda i, x: (i, x), **kwargs):
+        super().__init__(*args, **kwargs)
         self.title = title
         self.format_item = format_item
-        self.count = len(data)
 
     async def format_page(self, menu, page):
         embed = discord.Embed(
@@ -23,3 +29,117 @@ class EmbedFieldsPageSource(menus.ListPageSource):
             footer += f" out of {self.count}"
         embed.set_footer(text=footer)
         return embed
+
+
+class EmbedFieldsPageSource(EmbedFieldsMixin, menus.ListPageSource):
+    def __init__(self, data, title=None, format_item=lambda i, x: (i, x)):
+        super().__init__(data, per_page=5, title=title, format_item=format_item)
+        self.count = len(data)
+
+
+class KeysetPageSource(menus.PageSource):
+    """Pages through the results of a query one page at a time, without loading all of them.
+
+    Pages are read with keyset pagination on the key columns, which the query must select and which
+    must be unique together, e.g. (expires_at, id). Moving to a neighbouring page is an index range
+    scan from where the last one ended, and the page after the one being shown is fetched in the
+    background. Jumping into the middle falls back to OFFSET.
+    """
+
+    def __init__(self, pool: Pool, query: str, *args: Any, key: Sequence[str], per_page: int = 5):
+        self.pool = pool
+        self.query = query
+        self.args = args
+        self.key = key
+        self.per_page = per_page
+        self.count: int | None = None
+        self.pages: dict[int, asyncio.Task[list[Record]]] = {}
+
+    async def prepare(self):
+        # Called again by the menu when it starts, after the caller has already checked the count.
+        if self.count is not None:
+            return
+        first = self.fetch_page(0)
+        self.count = await self.pool.fetchval(
+            f"SELECT COUNT(*) FROM ({self.query}) AS results", *self.args
+        )
+        await first
+
+    def is_paginating(self):
+        return self.count is not None and self.count > self.per_page
+
+    def get_max_pages(self):
+        if self.count is None:
+            return None
+        return max(1, -(-self.count // self.per_page))
+
+    async def get_page(self, page_number):
+        page = await self.fetch_page(page_number)
+        max_pages = self.get_max_pages()
+        if max_pages is None or page_number + 1 < max_pages:
+            self.fetch_page(page_number + 1)
+        return page
+
+    def fetch_page(self, page_number: int) -> asyncio.Task[list[Record]]:
+        if (task := self.pages.get(page_number)) is None or task.cancelled():
+            task = asyncio.create_task(self._fetch_page(page_number))
+            self.pages[page_number] = task
+        return task
+
+    def _cursor(self, page_number: int) -> list[Record] | None:
+        task = self.pages.get(page_number)
+        if task is not None and task.done() and not task.cancelled() and not task.exception():
+            return task.result() or None
+        return None
+
+    async def _fetch_page(self, page_number: int) -> list[Record]:
+        key = ", ".join(self.key)
+        descending = ", ".join(f"{column} DESC" for column in self.key)
+        n = len(self.args)
+        bounds = ", ".join(f"${n + i + 1}" for i in range(len(self.key)))
+        limit = f"${n + len(self.key) + 1}"
+        max_pages = self.get_max_pages()
+        # Pages before a known one are read backwards from it, and flipped around afterwards.
+        backwards = False
+
+        if page_number == 0:
+            query = f"SELECT * FROM ({self.query}) AS results ORDER BY {key} LIMIT ${n + 1}"
+            args = [self.per_page]
+        elif previous := self._cursor(page_number - 1):
+            query = f"""
+                SELECT * FROM ({self.query}) AS results
+                WHERE ({key}) > ({bounds})
+                ORDER BY {key}
+                LIMIT {limit}
+            """
+            args = [*(previous[-1][column] for column in self.key), self.per_page]
+        elif following := self._cursor(page_number + 1):
+            query = f"""
+                SELECT * FROM ({self.query}) AS results
+                WHERE ({key}) < ({bounds})
+                ORDER BY {descending}
+                LIMIT {limit}
+            """
+            args = [*(following[0][column] for column in self.key), self.per_page]
+            backwards = True
+        elif max_pages is not None and page_number == max_pages - 1:
+            # The last page is the first one in reverse, and may not be full.
+            query = f"SELECT * FROM ({self.query}) AS results ORDER BY {descending} LIMIT ${n + 1}"
+            args = [(self.count or 0) - page_number * self.per_page]
+            backwards = True
+        else:
+            query = f"""
+                SELECT * FROM ({self.query}) AS results
+                ORDER BY {key}
+                LIMIT ${n + 1} OFFSET ${n + 2}
+            """
+            args = [self.per_page, page_number * self.per_page]
+
+        records = await self.pool.fetch(query, *self.args, *args)
+        if backwards:
+            records.reverse()
+        return records
+
+
+class EmbedFieldsKeysetPageSource(EmbedFieldsMixin, KeysetPageSource):
+    pass
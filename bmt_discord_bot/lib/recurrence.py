@@ -0,0 +1,179 @@
+import datetime
+import re
+
+from dateutil.rrule import rrule, rrulestr
+from discord.ext import commands
+
+from .time import DEFAULT_TIMEZONE
+
+PRESETS = {
+    "hourly": "FREQ=HOURLY",
+    "daily": "FREQ=DAILY",
+    "weekdays": "FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR",
+    "weekly": "FREQ=WEEKLY",
+    "biweekly": "FREQ=WEEKLY;INTERVAL=2",
+    "monthly": "FREQ=MONTHLY",
+    "yearly": "FREQ=YEARLY",
+}
+# Series can't repeat more often than this, so a typo can't turn into a reminder every minute.
+MIN_INTERVAL = datetime.timedelta(hours=1)
+DAYS_IN_MONTH = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+CRON_WEEKDAYS = ["SU", "MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+CRON_NAMES = {
+    **{day: i for i, day in enumerate(["SUN", "MON", "TUE", "WED", "THU", "FRI", "SAT"])},
+    **{
+        month: i
+        for i, month in enumerate(
+            ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"],
+            start=1,
+        )
+    },
+}
+# Field name, smallest and largest value, and the matching RRULE part.
+CRON_FIELDS = [
+    ("minute", 0, 59, "BYMINUTE"),
+    ("hour", 0, 23, "BYHOUR"),
+    ("day of month", 1, 31, "BYMONTHDAY"),
+    ("month", 1, 12, "BYMONTH"),
+    ("day of week", 0, 7, "BYDAY"),
+]
+CRON_PART_RE = re.compile(r"^(?:\*|(\w+)(?:-(\w+))?)(?:/(\d+))?$")
+
+
+def cron_number(value: str) -> int:
+    return CRON_NAMES[value] if value in CRON_NAMES else int(value)
+
+
+def cron_values(field: str, name: str, low: int, high: int) -> list[int] | None:
+    """Expands one cron field into the values it matches, or None if it matches everything."""
+
+    if field == "*":
+        return None
+    values = set()
+    for part in field.split(","):
+        match = CRON_PART_RE.match(part.upper())
+        if match is None:
+            raise commands.BadArgument(f"Could not understand the {name} field `{field}`.")
+        start, end, step = match.groups()
+        try:
+            first = low if start is None else cron_number(start)
+            if end is not None:
+                last = cron_number(end)
+            elif start is None or step is not None:
+                last = high
+            else:
+                last = first
+        except ValueError:
+            raise commands.BadArgument(f"Could not understand the {name} field `{field}`.")
+        if not low <= first <= last <= high:
+            raise commands.BadArgument(f"The {name} field `{field}` is out of range.")
+        values.update(range(first, last + 1, int(step or 1)))
+    return sorted(values)
+
+
+def cron_to_rrule(expression: str) -> str:
+    """Converts a five-field cron expression into the equivalent RRULE."""
+
+    fields = expression.split()
+    if len(fields) != 5:
+        raise commands.BadArgument("Cron expressions need five fields.")
+    values = [
+        cron_values(field, name, low, high)
+        for field, (name, low, high, _) in zip(fields, CRON_FIELDS)
+    ]
+    minutes, hours, days, _, weekdays = values
+    if days is not None and weekdays is not None:
+        # Cron matches either one, but RRULE parts all have to match.
+        raise commands.BadArgument("Cron expressions can't restrict both day of month and week.")
+
+    if minutes is None:
+        parts = ["FREQ=MINUTELY"]
+    elif hours is None:
+        parts = ["FREQ=HOURLY"]
+    else:
+        parts = ["FREQ=DAILY"]
+    for field_values, (_, _, _, rule) in zip(values, CRON_FIELDS):
+        if field_values is not None:
+            if rule == "BYDAY":
+                field_values = sorted({CRON_WEEKDAYS[v] for v in field_values})
+            parts.append(f"{rule}={','.join(map(str, field_values))}")
+    parts.append("BYSECOND=0")
+    return ";".join(parts)
+
+
+def check_dates(rule: str):
+    """Rejects rules that only fall on days none of their months have, like April 31st. dateutil
+    would search all the way to the year 9999 for them.
+    """
+
+    parts = dict(part.split("=", 1) for part in rule.split(";"))
+    if "BYMONTHDAY" not in parts:
+        return
+    days = [abs(int(day)) for day in parts["BYMONTHDAY"].split(",")]
+    months = [int(month) for month in parts["BYMONTH"].split(",")] if "BYMONTH" in parts else []
+    if not any(day <= DAYS_IN_MONTH[month - 1] for day in days for month in months or range(1, 13)):
+        raise commands.BadArgument(
+            "That never happens, since none of its months have that many days."
+        )
+
+
+def parse(text: str) -> str:
+    """Turns a preset name, cron expression or RRULE into an RRULE."""
+
+    text = text.strip()
+    if text.lower() in PRESETS:
+        return PRESETS[text.lower()]
+    if text.upper().startswith(("RRULE:", "FREQ=")):
+        rule = text.upper().removeprefix("RRULE:")
+        try:
+            rrulestr(rule, dtstart=datetime.datetime(2000, 1, 1))
+        except ValueError as e:
+            raise commands.BadArgument(f"Could not understand that RRULE: {e}")
+    else:
+        rule = cron_to_rrule(text)
+    check_dates(rule)
+    return rule
+
+
+def series(rule: str, start: datetime.datetime) -> str:
+    """Stores a rule together with the first occurrence it's counted from, as local wall-clock
+    time, so that e.g. a 9am reminder stays at 9am across daylight saving changes.
+    """
+
+    start = start.astimezone(DEFAULT_TIMEZONE).replace(tzinfo=None, microsecond=0)
+    return f"DTSTART:{start:%Y%m%dT%H%M%S}\nRRULE:{rule}"
+
+
+def load(recurrence: str) -> rrule:
+    return rrulestr(recurrence)
+
+
+# dateutil can't be told to stop looking for occurrences at some date; it only stops at one past
+# the end of the series or in the year 9999. Rules that never match, or only rarely, can take
+# seconds, so call these off the event loop.
+
+
+def validate(recurrence: str) -> datetime.datetime | None:
+    """Checks that a series doesn't repeat too often, and returns its first occurrence, or None
+    if it has none.
+    """
+
+    occurrences = list(load(recurrence).xafter(datetime.datetime.min, count=10, inc=True))
+    for a, b in zip(occurrences, occurrences[1:]):
+        if b - a < MIN_INTERVAL:
+            raise commands.BadArgument("Reminders can't repeat more than once an hour.")
+    return occurrences[0].replace(tzinfo=DEFAULT_TIMEZONE) if occurrences else None
+
+
+def next_occurrence(recurrence: str, after: datetime.datetime) -> datetime.datetime | None:
+    after = after.astimezone(DEFAULT_TIMEZONE).replace(tzinfo=None)
+    occurrence = load(recurrence).after(after)
+    return occurrence and occurrence.replace(tzinfo=DEFAULT_TIMEZONE)
+
+
+class Recurrence(commands.Converter):
+    """A preset like daily or weekly, a quoted cron expression or an RRULE."""
+
+    async def convert(self, ctx, argument: str) -> str:
+        return parse(argument)
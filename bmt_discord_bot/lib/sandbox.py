@@ -0,0 +1,108 @@
+import functools
+import multiprocessing
+import os
+import resource
+import signal
+import subprocess
+from typing import Any, Callable, NamedTuple
+
+
+class Limits(NamedTuple):
+    wall_time: float
+    cpu_time: int
+    memory: int
+
+
+class LimitExceeded(Exception):
+    pass
+
+
+def apply_limits(limits: Limits):
+    # The soft CPU limit delivers SIGXCPU, the hard limit a second later SIGKILL.
+    resource.setrlimit(resource.RLIMIT_CPU, (limits.cpu_time, limits.cpu_time + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (limits.memory, limits.memory))
+
+
+def describe_exit(returncode: int | None, limits: Limits) -> str:
+    if returncode in (-signal.SIGXCPU, -signal.SIGKILL):
+        return f"Compilation was stopped after using {limits.cpu_time} seconds of CPU time."
+    if returncode in (-signal.SIGABRT, -signal.SIGSEGV):
+        return (
+            f"Compilation was stopped after running out of memory ({limits.memory // 2**20} MiB)."
+        )
+    return f"Compilation crashed (exit status {returncode})."
+
+
+def popen(args: list[str], *, limits: Limits, **kwargs) -> subprocess.Popen:
+    """Starts a process under the given resource limits in its own process group, so that it and
+    anything it spawns can be killed together.
+
+    Limits are applied with preexec_fn, so only call this from single-threaded processes.
+    """
+
+    return subprocess.Popen(
+        args,
+        preexec_fn=functools.partial(apply_limits, limits),
+        start_new_session=True,
+        **kwargs,
+    )
+
+
+def kill_group(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def communicate(process: subprocess.Popen, input: bytes, *, limits: Limits):
+    """Like Popen.communicate, but kills the whole process group if the wall-clock limit passes,
+    and reaps any stray children once the process exits either way.
+    """
+
+    try:
+        return process.communicate(input, timeout=limits.wall_time)
+    except subprocess.TimeoutExpired:
+        kill_group(process)
+        process.communicate()
+        raise LimitExceeded(f"Compilation took longer than {limits.wall_time:g} seconds.")
+    finally:
+        kill_group(process)
+
+
+def _call_child(connection, limits: Limits, func: Callable, args, kwargs):
+    apply_limits(limits)
+    try:
+        result = (True, func(*args, **kwargs))
+    except Exception as e:
+        result = (False, e)
+    connection.send(result)
+    connection.close()
+
+
+def call(func: Callable, *args, limits: Limits, **kwargs) -> Any:
+    """Calls func in a forked child under the given limits and returns its result, re-raising
+    anything it raises. The child inherits the caller's memory, so warm state is not lost.
+    """
+
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_call_child, args=(sender, limits, func, args, kwargs))
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(limits.wall_time):
+            raise LimitExceeded(f"Compilation took longer than {limits.wall_time:g} seconds.")
+        ok, value = receiver.recv()
+    except EOFError:
+        process.join()
+        raise LimitExceeded(describe_exit(process.exitcode, limits))
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        receiver.close()
+
+    if not ok:
+        raise value
+    return value
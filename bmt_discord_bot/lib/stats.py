@@ -0,0 +1,69 @@
+import math
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+
+class RollingWindow:
+    """Keeps the most recent samples of a measurement and reports percentiles over them."""
+
+    def __init__(self, size: int = 1000):
+        self.samples: deque[float] = deque(maxlen=size)
+        self.total = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, value: float):
+        self.samples.append(value)
+        self.total += 1
+
+    def percentiles(self, *percents: float) -> list[float | None]:
+        """Nearest-rank percentiles of the current window, or None for an empty window."""
+
+        if not self.samples:
+            return [None for _ in percents]
+        ordered = sorted(self.samples)
+        return [ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] for p in percents]
+
+    def percentile(self, percent: float) -> float | None:
+        return self.percentiles(percent)[0]
+
+
+_active_timer: ContextVar["StageTimer | None"] = ContextVar("active_timer", default=None)
+
+
+class StageTimer:
+    """Adds up the time spent in each stage of a piece of work.
+
+    While a timer is active, code anywhere below it can mark a stage with timed() without the
+    timer being passed down. Outside an active timer timed() does nothing.
+    """
+
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def __enter__(self) -> "StageTimer":
+        self._token = _active_timer.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _active_timer.reset(self._token)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    timer = _active_timer.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(stage, time.perf_counter() - start)
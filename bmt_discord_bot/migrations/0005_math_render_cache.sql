@@ -0,0 +1,6 @@
+CREATE TABLE math_render_cache (
+    key TEXT PRIMARY KEY,
+    pages BYTEA[] NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    accessed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1 @@
+DROP TABLE math_render_cache;
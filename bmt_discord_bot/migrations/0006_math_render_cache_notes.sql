@@ -0,0 +1,2 @@
+ALTER TABLE math_render_cache
+    ADD COLUMN notes TEXT[] NOT NULL DEFAULT '{}';
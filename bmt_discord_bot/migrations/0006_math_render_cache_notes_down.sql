@@ -0,0 +1,2 @@
+ALTER TABLE math_render_cache
+    DROP COLUMN notes;
@@ -0,0 +1,2 @@
+ALTER TABLE math_settings
+    ADD COLUMN prefetch BOOLEAN NOT NULL DEFAULT FALSE;
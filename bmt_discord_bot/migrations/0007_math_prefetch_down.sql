@@ -0,0 +1,2 @@
+ALTER TABLE math_settings
+    DROP COLUMN prefetch;
@@ -0,0 +1,21 @@
+ALTER TABLE reminders
+    ADD COLUMN leased_until TIMESTAMPTZ,
+    ADD COLUMN leased_by TEXT;
+
+CREATE FUNCTION notify_reminders() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('reminders', json_build_object('op', TG_OP, 'id', OLD.id)::TEXT);
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify(
+        'reminders',
+        json_build_object('op', TG_OP, 'id', NEW.id, 'expires_at', NEW.expires_at)::TEXT
+    );
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER reminders_notify
+    AFTER INSERT OR DELETE ON reminders
+    FOR EACH ROW EXECUTE FUNCTION notify_reminders();
@@ -0,0 +1,6 @@
+DROP TRIGGER reminders_notify ON reminders;
+DROP FUNCTION notify_reminders;
+
+ALTER TABLE reminders
+    DROP COLUMN leased_until,
+    DROP COLUMN leased_by;
@@ -0,0 +1,28 @@
+-- The scheduler and catch-up read pending reminders in (expires_at, id) order, and reminder
+-- lists read one user's pending reminders in the same order.
+CREATE INDEX reminders_pending_idx ON reminders (expires_at, id) WHERE NOT is_resolved;
+CREATE INDEX reminders_user_pending_idx ON reminders (user_id, expires_at, id) WHERE NOT is_resolved;
+CREATE INDEX reminders_leased_idx ON reminders (leased_until)
+    WHERE NOT is_resolved AND leased_until IS NOT NULL;
+
+-- Resolved reminders are moved here after a while, and dropped from here after a longer while.
+-- Columns added to reminders have to be added here too, in the same order.
+CREATE TABLE reminders_archive (LIKE reminders);
+CREATE INDEX reminders_archive_expires_at_idx ON reminders_archive (expires_at);
+
+-- Moving resolved reminders out shouldn't wake up every scheduler.
+CREATE OR REPLACE FUNCTION notify_reminders() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        IF NOT OLD.is_resolved THEN
+            PERFORM pg_notify('reminders', json_build_object('op', TG_OP, 'id', OLD.id)::TEXT);
+        END IF;
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify(
+        'reminders',
+        json_build_object('op', TG_OP, 'id', NEW.id, 'expires_at', NEW.expires_at)::TEXT
+    );
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
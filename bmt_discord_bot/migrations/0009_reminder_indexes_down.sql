@@ -0,0 +1,19 @@
+CREATE OR REPLACE FUNCTION notify_reminders() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('reminders', json_build_object('op', TG_OP, 'id', OLD.id)::TEXT);
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify(
+        'reminders',
+        json_build_object('op', TG_OP, 'id', NEW.id, 'expires_at', NEW.expires_at)::TEXT
+    );
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TABLE reminders_archive;
+
+DROP INDEX reminders_pending_idx;
+DROP INDEX reminders_user_pending_idx;
+DROP INDEX reminders_leased_idx;
@@ -0,0 +1,10 @@
+-- An RRULE with its DTSTART, in local time. Recurring reminders are rescheduled in place rather
+-- than resolved when they're sent.
+ALTER TABLE reminders ADD COLUMN recurrence TEXT;
+ALTER TABLE reminders_archive ADD COLUMN recurrence TEXT;
+
+CREATE TRIGGER reminders_notify_reschedule
+    AFTER UPDATE OF expires_at ON reminders
+    FOR EACH ROW
+    WHEN (NEW.expires_at IS DISTINCT FROM OLD.expires_at AND NOT NEW.is_resolved)
+    EXECUTE FUNCTION notify_reminders();
@@ -0,0 +1,4 @@
+DROP TRIGGER reminders_notify_reschedule ON reminders;
+
+ALTER TABLE reminders DROP COLUMN recurrence;
+ALTER TABLE reminders_archive DROP COLUMN recurrence;